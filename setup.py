@@ -22,7 +22,6 @@ setup(
     url='https://github.com/vita-epfl/trajnetplusplusdataset',
 
     install_requires=[
-        'pysparkling',
         'scipy',
         'trajnetplusplustools',
     ],
@@ -33,6 +32,12 @@ setup(
         ],
         'plot': [
             'matplotlib',
-        ]
+        ],
+        'hdf5': [
+            'h5py',
+        ],
+        'scripts': [
+            'pysparkling',
+        ],
     },
 )
@@ -0,0 +1,88 @@
+import argparse
+
+import numpy as np
+import pytest
+from trajnetplusplustools.interactions import check_interaction, group, get_interaction_type
+
+from trajnetdataset.interactions import interaction_types, pad, scene_interactions
+
+OBS_LEN = 9
+N_FRAMES = 21
+
+
+def walker(start, velocity):
+    return np.asarray(start, dtype=float) + np.arange(N_FRAMES)[:, None] * np.asarray(velocity)
+
+
+def scenes():
+    """Scenes (frames, pedestrians, 2) with every interaction type, NaN gaps
+    and single-pedestrian scenes."""
+    rng = np.random.RandomState(0)
+    primary = walker([0, 0], [0.4, 0])
+    result = [
+        primary[:, None],  # alone
+        np.stack([primary, walker([0, 0.5], [0.4, 0])], axis=1),  # group
+        np.stack([primary, walker([1.5, 0], [0.4, 0])], axis=1),  # leader follower
+        np.stack([primary, walker([12, 0.2], [-0.4, 0])], axis=1),  # collision avoidance
+        np.stack([primary, walker([0, -8], [0, 0.4])], axis=1),  # crossing
+        ## group with the Type III thresholds only, not with the Group thresholds
+        np.stack([primary, walker([0, 1.2], [0.4, 0])], axis=1),
+        ## close companion just outside the side cone of groups, at 40 degrees
+        np.stack([primary, walker([0.6 * np.cos(np.radians(40)), 0.6 * np.sin(np.radians(40))],
+                                  [0.4, 0])], axis=1),
+    ]
+    ## leaders in front for 4 (no LF) and 5 (LF) predicted frames
+    for n_frames in (4, 5):
+        leader = walker([1.5, 0], [0.4, 0])
+        leader[:OBS_LEN - 3] = np.nan
+        leader[OBS_LEN + n_frames:] = np.nan
+        result.append(np.stack([primary, leader], axis=1))
+    for _ in range(20):
+        n_peds = rng.randint(1, 6)
+        xy = np.cumsum(rng.normal(0, 0.3, (N_FRAMES, n_peds, 2)), axis=0)
+        xy[:, 0] += walker([0, 0], rng.uniform(-0.5, 0.5, 2))
+        xy[:, 1:] += rng.uniform(-4, 4, (1, n_peds - 1, 2))
+        ## neighbours entering late, leaving early or missing a frame
+        for p in range(1, n_peds):
+            start, end = sorted(rng.randint(0, N_FRAMES + 1, 2))
+            xy[:start, p] = np.nan
+            xy[end:, p] = np.nan
+        result.append(xy)
+    return result
+
+
+def expected(xy, args):
+    interaction = (np.any(check_interaction(xy, pos_range=args.inter_pos_range,
+                                            dist_thresh=args.inter_dist_thresh,
+                                            obs_len=args.obs_len))
+                   or np.any(group(xy, args.grp_dist_thresh, args.grp_std_thresh,
+                                   args.obs_len)))
+    types = get_interaction_type(xy, args.inter_pos_range, args.inter_dist_thresh,
+                                 args.obs_len)
+    return bool(interaction), types
+
+
+@pytest.mark.parametrize('thresholds', [
+    dict(inter_pos_range=15, inter_dist_thresh=5, grp_dist_thresh=0.8, grp_std_thresh=0.2),
+    dict(inter_pos_range=30, inter_dist_thresh=3, grp_dist_thresh=1.5, grp_std_thresh=0.4),
+])
+def test_interaction_types_match_trajnetplusplustools(thresholds):
+    args = argparse.Namespace(obs_len=OBS_LEN, **thresholds)
+    scenes_xy = scenes()
+
+    result = interaction_types(scenes_xy, args)
+    assert result == [expected(xy, args) for xy in scenes_xy]
+
+    ## every interaction type is covered
+    assert {t for _, types in result for t in types} == {1, 2, 3, 4}
+
+
+def test_padding_does_not_change_scenes():
+    args = argparse.Namespace(obs_len=OBS_LEN, inter_pos_range=15, inter_dist_thresh=5,
+                              grp_dist_thresh=0.8, grp_std_thresh=0.2)
+    scenes_xy = scenes()
+    interaction, types = scene_interactions(pad(scenes_xy), args)
+    for xy, scene_interaction, scene_types in zip(scenes_xy, interaction, types):
+        single_interaction, single_types = scene_interactions(xy[None], args)
+        assert scene_interaction == single_interaction[0]
+        assert (scene_types == single_types[0]).all()
@@ -0,0 +1,47 @@
+import argparse
+
+import numpy as np
+import pytest
+import trajnetplusplustools
+from trajnetplusplustools import TrackRow
+
+from trajnetdataset import kalman
+from trajnetdataset.sweep import acceptance_draws
+
+SEED = 42
+OBS_LEN = 9
+PRED_LEN = 12
+
+
+def primary_path(scene_id):
+    """Rounded primary path of a walking or nearly static pedestrian."""
+    rng = np.random.RandomState(scene_id)
+    velocity = rng.uniform(-0.5, 0.5, 2) * (scene_id % 3 != 0)
+    xy = rng.uniform(-5, 5, 2) + np.cumsum(velocity + rng.normal(0, 0.05, (OBS_LEN + PRED_LEN, 2)),
+                                           axis=0)
+    return [TrackRow(10 * t, scene_id, round(x, 2), round(y, 2))
+            for t, (x, y) in enumerate(xy.tolist())]
+
+
+@pytest.mark.parametrize('scene_ids', [[0, 1, 2, 3, 4, 5], [17]])
+def test_final_l2_matches_trajnetplusplustools(scene_ids):
+    paths = [primary_path(scene_id) for scene_id in scene_ids]
+
+    expected_fde = []
+    expected_draws = []
+    for scene_id, path in zip(scene_ids, paths):
+        np.random.seed([SEED, scene_id])
+        prediction, _ = trajnetplusplustools.kalman.predict([path], OBS_LEN, PRED_LEN)[0]
+        expected_fde.append(trajnetplusplustools.metrics.final_l2(path, prediction))
+        expected_draws.append(np.random.uniform())
+
+    observations = np.array([[(r.x, r.y) for r in path[:OBS_LEN]] for path in paths])
+    final_positions = np.array([(path[-1].x, path[-1].y) for path in paths])
+    random_states = [np.random.RandomState([SEED, scene_id]) for scene_id in scene_ids]
+    fde = kalman.final_l2(observations, final_positions, PRED_LEN, random_states)
+    np.testing.assert_allclose(fde, expected_fde, rtol=0, atol=1e-9)
+
+    ## the random stream continues as after the samples of pykalman
+    assert [random_state.uniform() for random_state in random_states] == expected_draws
+    args = argparse.Namespace(seed=SEED, pred_len=PRED_LEN)
+    assert [acceptance_draws(scene_id, args)[1] for scene_id in scene_ids] == expected_draws
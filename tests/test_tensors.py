@@ -0,0 +1,70 @@
+import argparse
+
+import numpy as np
+import pytest
+from trajnetplusplustools import Reader
+
+from trajnetdataset.tracks import Tracks
+
+pytest.importorskip('rvo2')
+from trajnetdataset import convert  # noqa: E402
+
+OBS_LEN = 9
+PRED_LEN = 12
+
+
+def convert_args(**kwargs):
+    """Arguments of convert with its defaults."""
+    args = dict(
+        obs_len=OBS_LEN, pred_len=PRED_LEN, train_fraction=0.6, val_fraction=0.2, fps=2.5,
+        order_frames=False, chunk_stride=2, min_length=0.0, proximity_radius=None,
+        synthetic=False, direct=False, all_present=False, orca_file=None, goal_file=None,
+        output_filename=None, mode='default', write_pre=False, compression=None,
+        tensors=True, metrics=False, metric_pos_ranges=None, seed=42, processes=None,
+        cache_dir=None, cache_max_size=10000, cache_max_age=30,
+        static_threshold=1.0, linear_threshold=0.5, inter_dist_thresh=5,
+        inter_pos_range=15, grp_dist_thresh=0.8, grp_std_thresh=0.2,
+        acceptance=[1, 1, 1, 1],
+    )
+    args.update(kwargs)
+    return argparse.Namespace(**args)
+
+
+def crowd():
+    """Pedestrians crossing a small square, entering and leaving at random frames."""
+    rng = np.random.RandomState(0)
+    frame, pedestrian, x, y = [], [], [], []
+    for p in range(60):
+        start = rng.randint(0, 200)
+        n_frames = rng.randint(5, 40)
+        xy = (rng.uniform(-3, 3, 2) + np.arange(n_frames)[:, None] * rng.uniform(-0.4, 0.4, 2)
+              + np.cumsum(rng.normal(0, 0.05, (n_frames, 2)), axis=0))
+        frame += [10 * (start + t) for t in range(n_frames)]
+        pedestrian += [p] * n_frames
+        x += xy[:, 0].tolist()
+        y += xy[:, 1].tolist()
+    order = np.argsort(frame, kind='stable')
+    return Tracks(np.array(frame)[order], np.array(pedestrian)[order],
+                  np.array(x)[order], np.array(y)[order])
+
+
+def test_public_tensors_match_public_file(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    convert.write_and_categorize(crowd(), 'output_pre/{split}/crowd.ndjson', convert_args())
+
+    records = np.load('output/test/crowd.npy')
+    scenes = list(Reader('output/test/crowd.ndjson', scene_type='paths').scenes())
+    private = np.load('output/test_private/crowd.npy')
+    assert len(records) == len(scenes) == len(private) > 0
+    ## some neighbours are only in the predicted frames of the private scenes
+    assert np.any(records['num_peds'] < private['num_peds'])
+
+    for record, (scene_id, paths) in zip(records, scenes):
+        assert record['scene'] == scene_id
+        assert record['tag'] == 0
+        xy = Reader.paths_to_xy([paths[0][:OBS_LEN]] + paths[1:])
+        num_peds = record['num_peds']
+        assert num_peds == xy.shape[1]
+        np.testing.assert_allclose(record['xy'][:OBS_LEN, :num_peds], xy, atol=1e-5)
+        assert np.all(np.isnan(record['xy'][OBS_LEN:]))
+        assert np.all(np.isnan(record['xy'][:, num_peds:]))
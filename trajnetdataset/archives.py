@@ -0,0 +1,110 @@
+""" Open raw files, compressed files and members of tar/zip archives
+
+A path continues into an archive with the name of a member, e.g.
+``data/ewap_dataset_light.tgz/ewap_dataset/seq_hotel/obsmat.txt``.
+Archive patterns match member names with fnmatch, so ``*`` also
+matches ``/``.
+"""
+
+import bz2
+import contextlib
+import fnmatch
+import glob as glob_
+import gzip
+import io
+import lzma
+import os
+import tarfile
+import zipfile
+
+TAR_SUFFIXES = ('.tar', '.tgz', '.tar.gz', '.tbz2', '.tar.bz2', '.txz', '.tar.xz')
+ZIP_SUFFIXES = ('.zip',)
+COMPRESSED_OPENERS = {'.gz': gzip.open, '.bz2': bz2.open, '.xz': lzma.open}
+
+
+def split(path):
+    """Split path into (archive, member), or (None, path) outside of archives."""
+    parts = path.split('/')
+    for i in range(1, len(parts)):
+        archive = '/'.join(parts[:i])
+        if archive.endswith(TAR_SUFFIXES + ZIP_SUFFIXES) and os.path.isfile(archive):
+            return archive, '/'.join(parts[i:])
+    return None, path
+
+
+def iter_members(archive):
+    """Yield (member name, binary file) of all files in one sequential pass."""
+    if archive.endswith(ZIP_SUFFIXES):
+        with zipfile.ZipFile(archive) as zf:
+            for info in zf.infolist():
+                if not info.is_dir():
+                    with zf.open(info) as f:
+                        yield info.filename, f
+        return
+
+    with tarfile.open(archive, 'r|*') as tf:  # stream mode, no seeking
+        for info in tf:
+            if info.isfile():
+                yield info.name, tf.extractfile(info)
+
+
+def glob(pattern):
+    """Sorted file names matching pattern, inside archives too."""
+    archive, member = split(pattern)
+    if archive is None:
+        return sorted(glob_.glob(pattern))
+    return sorted(archive + '/' + name
+                  for name, _ in iter_members(archive)
+                  if fnmatch.fnmatchcase(name, member))
+
+
+def decode(binary_file):
+    """Read as text with universal newlines like open()."""
+    content = io.BytesIO(binary_file.read())
+    return io.TextIOWrapper(content, encoding='utf8', errors='ignore').read()
+
+
+def read_files(pattern, keep=None):
+    """Read all files matching pattern as sorted (file name, content) pairs.
+
+    Members of an archive are read in a single sequential pass over
+    the archive. keep is an optional predicate on the file name.
+    """
+    archive, member = split(pattern)
+    if archive is None:
+        return [(file_name, read_text(file_name))
+                for file_name in glob(pattern)
+                if keep is None or keep(file_name)]
+
+    contents = []
+    for name, f in iter_members(archive):
+        file_name = archive + '/' + name
+        if fnmatch.fnmatchcase(name, member) and (keep is None or keep(file_name)):
+            contents.append((file_name, decode(f)))
+    return sorted(contents)
+
+
+@contextlib.contextmanager
+def open_binary(path):
+    archive, member = split(path)
+    if archive is None:
+        opener = COMPRESSED_OPENERS.get(os.path.splitext(path)[1], open)
+        with opener(path, 'rb') as f:
+            yield f
+    elif archive.endswith(ZIP_SUFFIXES):
+        with zipfile.ZipFile(archive) as zf, zf.open(member) as f:
+            yield f
+    else:
+        with tarfile.open(archive) as tf, tf.extractfile(member) as f:
+            yield f
+
+
+@contextlib.contextmanager
+def open_text(path):
+    with open_binary(path) as f:
+        yield io.TextIOWrapper(f, encoding='utf8', errors='ignore')
+
+
+def read_text(path):
+    with open_binary(path) as f:
+        return decode(f)
@@ -0,0 +1,104 @@
+""" Content-addressed cache of parsed raw datasets
+
+Parsed Tracks are stored as structured .npy files in a cache
+directory. The file name is a hash of the input content, the reader
+and its parameters, so any change of the raw data or of the parsing
+leads to a new entry. Hits are memory-mapped instead of parsed again.
+"""
+
+import functools
+import hashlib
+import json
+import os
+import time
+
+import numpy as np
+
+from . import archives
+from .tracks import Tracks
+
+## Change to invalidate all entries when the cache format changes
+VERSION = 1
+
+
+def describe(value):
+    """JSON compatible description of functions, e.g. readers."""
+    if isinstance(value, functools.partial):
+        return [describe(value.func), list(value.args), value.keywords]
+    return value.__module__ + '.' + value.__qualname__
+
+
+def input_digest(input_file, block_size=1 << 20):
+    """Hash of the content of all files that input_file refers to.
+
+    For a member of an archive, the whole archive and the member name
+    are hashed.
+    """
+    digest = hashlib.sha256()
+    archive, member = archives.split(input_file)
+    if archive is not None:
+        digest.update(member.encode('utf8'))
+        file_names = [archive]
+    else:
+        file_names = archives.glob(input_file)
+
+    for file_name in file_names:
+        digest.update(os.path.basename(file_name).encode('utf8'))
+        with open(file_name, 'rb') as f:
+            for block in iter(lambda: f.read(block_size), b''):
+                digest.update(block)
+    return digest.hexdigest()
+
+
+def key(read, input_file, params):
+    description = json.dumps([VERSION, describe(read), params, input_digest(input_file)],
+                             sort_keys=True, default=describe)
+    return hashlib.sha256(description.encode('utf8')).hexdigest()
+
+
+def evict(cache_dir, max_size=None, max_age=None):
+    """Remove entries older than max_age seconds and then the least
+    recently used entries until the cache is below max_size bytes."""
+    entries = []
+    now = time.time()
+    for entry in os.scandir(cache_dir):
+        if not entry.name.endswith('.npy'):
+            continue
+        stat = entry.stat()
+        if max_age is not None and now - stat.st_mtime > max_age:
+            os.remove(entry.path)
+            continue
+        entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+    if max_size is None:
+        return
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= max_size:
+            break
+        os.remove(path)
+        total -= size
+
+
+def cached_tracks(cache_dir, read, input_file, max_size=None, max_age=None, **params):
+    """Tracks of read(input_file, **params), parsed at most once.
+
+    Without a cache_dir, this just calls read. The parameters can be
+    plain values, functions or functools.partial objects.
+    """
+    if cache_dir is None:
+        return read(input_file, **params)
+
+    os.makedirs(cache_dir, exist_ok=True)
+    file_name = os.path.join(cache_dir, key(read, input_file, params) + '.npy')
+    if os.path.exists(file_name):
+        os.utime(file_name)  # mark as recently used
+        return Tracks.from_records(np.load(file_name, mmap_mode='r'))
+
+    tracks = read(input_file, **params)
+    tmp_file_name = '{}.{}.tmp'.format(file_name, os.getpid())
+    with open(tmp_file_name, 'wb') as f:
+        np.save(f, tracks.to_records())
+    os.replace(tmp_file_name, file_name)
+    evict(cache_dir, max_size, max_age)
+    return tracks
@@ -1,187 +1,206 @@
 """Create Trajnet data from original datasets."""
 import argparse
+import functools
 import shutil
 import numpy as np
 import random
 
-import pysparkling
-import scipy.io
-
+from . import cache
 from . import readers
 from .scene import Scenes
 from .get_type import trajectory_type
+from .tracks import as_tracks
 
 import warnings
 warnings.filterwarnings("ignore")
 
-def biwi(sc, input_file):
+def parse(read, input_file, args=None, **params):
+    """Parse input_file into Tracks, through the parse cache with args.cache_dir."""
+    if args is None:
+        return read(input_file, **params)
+    return cache.cached_tracks(args.cache_dir, read, input_file,
+                               max_size=args.cache_max_size * 1000000,
+                               max_age=args.cache_max_age * 86400,
+                               **params)
+
+def biwi(input_file, args=None):
     print('processing ' + input_file)
-    return (sc
-            .textFile(input_file)
-            .map(readers.biwi)
-            .cache())
+    return parse(readers.biwi_bulk, input_file, args)
 
 
-def crowds(sc, input_file):
+def crowds(input_file, args=None):
     print('processing ' + input_file)
-    return (sc
-            .wholeTextFiles(input_file)
-            .values()
-            .flatMap(readers.crowds)
-            .cache())
+    return parse(readers.crowds_files, input_file, args)
 
 
-def mot(sc, input_file):
+def mot(input_file, args=None):
     """Was 7 frames per second in original recording."""
     print('processing ' + input_file)
-    return (sc
-            .textFile(input_file)
-            .map(readers.mot)
-            .filter(lambda r: r.frame % 2 == 0)
-            .cache())
+    return parse(readers.mot_bulk, input_file, args, frame_stride=2)
 
 
-def edinburgh(sc, input_file):
+def mot_xml(input_file, args=None):
+    """PETS2009 XML annotations, streamed frame by frame."""
     print('processing ' + input_file)
-    return (sc
-            .wholeTextFiles(input_file)
-            .zipWithIndex()
-            .flatMap(readers.edinburgh)
-            .cache())
+    return parse(readers.mot_xml_bulk, input_file, args)
 
 
-def syi(sc, input_file):
+def edinburgh(input_file, args=None):
     print('processing ' + input_file)
-    return (sc
-            .wholeTextFiles(input_file)
-            .flatMap(readers.syi)
-            .cache())
+    return parse(readers.files_parallel, input_file, args,
+                 reader=readers.edinburgh, with_index=True)
 
 
-def dukemtmc(sc, input_file):
+def syi(input_file, args=None):
     print('processing ' + input_file)
-    contents = scipy.io.loadmat(input_file)['trainData']
-    return (sc
-            .parallelize(readers.dukemtmc(contents))
-            .cache())
+    return parse(readers.files_parallel, input_file, args, reader=readers.syi)
 
 
-def wildtrack(sc, input_file):
+def dukemtmc(input_file, args=None):
     print('processing ' + input_file)
-    return (sc
-            .wholeTextFiles(input_file)
-            .flatMap(readers.wildtrack)
-            .cache())
+    return parse(readers.dukemtmc_bulk, input_file, args)
 
-def cff(sc, input_file):
-    print('processing ' + input_file)
-    return (sc
-            .textFile(input_file)
-            .map(readers.cff)
-            .filter(lambda r: r is not None)
-            .cache())
 
-def lcas(sc, input_file):
+def wildtrack(input_file, args=None):
     print('processing ' + input_file)
-    return (sc
-            .textFile(input_file)
-            .map(readers.lcas)
-            .cache())
+    return parse(readers.files_parallel, input_file, args, reader=readers.wildtrack)
 
-def controlled(sc, input_file):
+def cff(input_file, args=None):
     print('processing ' + input_file)
-    return (sc
-            .textFile(input_file)
-            .map(readers.controlled)
-            .cache())
+    return parse(readers.cff_parallel, input_file, args)
 
-def get_trackrows(sc, input_file):
+def lcas(input_file, args=None):
     print('processing ' + input_file)
-    return (sc
-            .textFile(input_file)
-            .map(readers.get_trackrows)
-            .filter(lambda r: r is not None)
-            .cache())
+    return parse(readers.lcas_bulk, input_file, args)
 
-def standard(sc, input_file):
+def controlled(input_file, args=None):
     print('processing ' + input_file)
-    return (sc
-            .textFile(input_file)
-            .map(readers.standard)
-            .cache())
+    return parse(readers.controlled_bulk, input_file, args)
 
-def car_data(sc, input_file):
+def standard(input_file, args=None):
     print('processing ' + input_file)
-    return (sc
-            .wholeTextFiles(input_file)
-            .flatMap(readers.car_data)
-            .cache())
+    return parse(readers.standard_bulk, input_file, args)
 
-def write(input_rows, output_file, args):
-    """ Write Valid Scenes without categorization """
-
-    print(" Entering Writing ")
+def car_data(input_file, args=None, frame_stride=12):
+    print('processing ' + input_file)
+    # only read the files of frames that are kept
+    return parse(readers.files_parallel, input_file, args,
+                 reader=functools.partial(readers.car_data, frame_stride=frame_stride),
+                 keep=lambda f: readers.car_data_frame(f) % frame_stride == 0)
+
+def split_rows(input_rows, args):
+    """Split rows into train, val and test by contiguous ranges of frames.
+
+    The rows are sorted once by the position of their frame in the
+    frame order and sliced. Every split keeps the original order of
+    its rows. With order_frames, frames are ordered by frame % 100000
+    and then by frame.
+    """
+    frames, frame_of_row = np.unique(input_rows.frame, return_inverse=True)
+    frame_order = np.arange(len(frames))
     ## To handle two different time stamps 7:00 and 17:00 of cff
     if args.order_frames:
-        frames = sorted(set(input_rows.map(lambda r: r.frame).toLocalIterator()),
-                        key=lambda frame: frame % 100000)
-    else:
-        frames = sorted(set(input_rows.map(lambda r: r.frame).toLocalIterator()))
+        frame_order = np.argsort(frames % 100000, kind='stable')
 
     # split
     train_split_index = int(len(frames) * args.train_fraction)
     val_split_index = train_split_index + int(len(frames) * args.val_fraction)
-    train_frames = set(frames[:train_split_index])
-    val_frames = set(frames[train_split_index:val_split_index])
-    test_frames = set(frames[val_split_index:])
+
+    # 0: train, 1: val, 2: test
+    frame_split = np.zeros(len(frames), dtype=np.int64)
+    frame_split[frame_order[train_split_index:]] = 1
+    frame_split[frame_order[val_split_index:]] = 2
+    row_split = frame_split[frame_of_row.reshape(-1)]
+
+    order = np.argsort(row_split, kind='stable')
+    bounds = np.searchsorted(row_split[order], [0, 1, 2, 3])
+    return [input_rows.filter(order[start:end]) for start, end in zip(bounds[:-1], bounds[1:])]
+
+def write(input_rows, output_file, args, write_files=True):
+    """ Write Valid Scenes without categorization
+
+    Returns the train, val and test Scenes, which keep the generated
+    scenes and tracks for categorize(). With write_files=False, nothing
+    is written to output_file.
+    """
+
+    print(" Entering Writing ")
+    train_rows, val_rows, test_rows = split_rows(as_tracks(input_rows), args)
 
     # train dataset
-    train_rows = input_rows.filter(lambda r: r.frame in train_frames)
     train_output = output_file.format(split='train')
-    train_scenes = Scenes(fps=args.fps, start_scene_id=0, args=args).rows_to_file(train_rows, train_output)
+    train_scenes = Scenes(fps=args.fps, start_scene_id=0, args=args).rows_to_file(
+        train_rows, train_output, write_files)
 
     # validation dataset
-    val_rows = input_rows.filter(lambda r: r.frame in val_frames)
     val_output = output_file.format(split='val')
-    val_scenes = Scenes(fps=args.fps, start_scene_id=train_scenes.scene_id, args=args).rows_to_file(val_rows, val_output)
+    val_scenes = Scenes(fps=args.fps, start_scene_id=train_scenes.scene_id, args=args).rows_to_file(
+        val_rows, val_output, write_files)
 
-    # public test dataset
-    test_rows = input_rows.filter(lambda r: r.frame in test_frames)
+    # public and private test dataset, from the same scenes
     test_output = output_file.format(split='test')
-    test_scenes = Scenes(fps=args.fps, start_scene_id=val_scenes.scene_id, args=args) # !!! Chunk Stride
-    test_scenes.rows_to_file(test_rows, test_output)
-
-    # private test dataset
     private_test_output = output_file.format(split='test_private')
-    private_test_scenes = Scenes(fps=args.fps, start_scene_id=val_scenes.scene_id, args=args)
-    private_test_scenes.rows_to_file(test_rows, private_test_output)
-
-def categorize(sc, input_file, args):
-    """ Categorize the Scenes """
+    test_scenes = Scenes(fps=args.fps, start_scene_id=val_scenes.scene_id, args=args) # !!! Chunk Stride
+    test_scenes.rows_to_test_files(test_rows, test_output, private_test_output, write_files)
+
+    return train_scenes, val_scenes, test_scenes
+
+def categorize_split(path, track_id, args, scenes=None):
+    """ Categorize one split, read from path or taken from its Scenes """
+    if scenes is None:
+        print('processing ' + path)
+        rows, scene_rows = readers.trajnet_bulk(path)
+        return trajectory_type(rows, path, fps=args.fps, track_id=track_id, args=args,
+                               scene_rows=scene_rows)
+
+    ## categorize the tracks as they are written, with rounded positions
+    test_rows = None
+    if scenes.observed_tracks is not None:
+        test_rows = scenes.observed_tracks.rounded()
+    return trajectory_type(scenes.tracks.rounded(), path, fps=args.fps, track_id=track_id,
+                           args=args, scene_rows=scenes.scenes, test_rows=test_rows)
+
+def categorize(input_file, args, scenes=None):
+    """ Categorize the Scenes
+
+    Without scenes, the files written by write() are read back. scenes
+    are the (train, val, test) Scenes returned by write() and are
+    categorized in memory.
+    """
 
     print(" Entering Categorizing ")
     test_fraction = 1 - args.train_fraction - args.val_fraction
+    train_scenes, val_scenes, test_scenes = scenes or (None, None, None)
 
     train_id = 0
     if args.train_fraction:
         print("Categorizing Training Set")
-        train_rows = get_trackrows(sc, input_file.replace('split', '').format('train'))
-        train_id = trajectory_type(train_rows, input_file.replace('split', '').format('train'),
-                                   fps=args.fps, track_id=0, args=args)
+        train_id = categorize_split(input_file.replace('split', '').format('train'),
+                                    track_id=0, args=args, scenes=train_scenes)
 
     val_id = train_id
     if args.val_fraction:
         print("Categorizing Validation Set")
-        val_rows = get_trackrows(sc, input_file.replace('split', '').format('val'))
-        val_id = trajectory_type(val_rows, input_file.replace('split', '').format('val'),
-                                 fps=args.fps, track_id=train_id, args=args)
+        val_id = categorize_split(input_file.replace('split', '').format('val'),
+                                  track_id=train_id, args=args, scenes=val_scenes)
 
 
     if test_fraction:
         print("Categorizing Test Set")
-        test_rows = get_trackrows(sc, input_file.replace('split', '').format('test_private'))
-        _ = trajectory_type(test_rows, input_file.replace('split', '').format('test_private'),
-                            fps=args.fps, track_id=val_id, args=args)
+        _ = categorize_split(input_file.replace('split', '').format('test_private'),
+                             track_id=val_id, args=args, scenes=test_scenes)
+
+def write_and_categorize(input_rows, output_file, args):
+    """ Write Valid Scenes and categorize them in memory
+
+    The uncategorized scenes in output_file are only written with
+    --write_pre, as debug output. With --compression, all files get
+    the suffix of the compression.
+    """
+    if args.compression:
+        output_file += '.' + args.compression
+    scenes = write(input_rows, output_file, args, write_files=args.write_pre)
+    categorize(output_file, args, scenes)
 
 def edit_goal_file(old_filename, new_filename):
     """ Rename goal files. 
@@ -210,6 +229,9 @@ def main():
                         help='Sampling Stride')
     parser.add_argument('--min_length', default=0.0, type=float,
                         help='Min Length of Primary Trajectory')
+    parser.add_argument('--proximity_radius', default=None, type=float,
+                        help='Radius for pedestrians to be close to each other '
+                             '(default: share a 10m grid cell)')
     parser.add_argument('--synthetic', action='store_true',
                         help='convert synthetic datasets (if false, convert real)')
     parser.add_argument('--direct', action='store_true',
@@ -224,6 +246,28 @@ def main():
                         help='name of the output dataset filename constructed in .ndjson format, required in direct mode')
     parser.add_argument('--mode', default='default', choices=('default', 'trajnet'),
                         help='mode of ORCA scene generation (required for ORCA sensitive scene filtering)')
+    parser.add_argument('--write_pre', action='store_true',
+                        help='also write the uncategorized scenes to output_pre')
+    parser.add_argument('--compression', default=None, choices=('gz', 'bz2', 'xz'),
+                        help='compress the output files')
+    parser.add_argument('--tensors', action='store_true',
+                        help='also write the categorized scenes as .npy scene tensors')
+    parser.add_argument('--metrics', action='store_true',
+                        help='save per-scene categorization metrics for trajnetdataset.sweep')
+    parser.add_argument('--metric_pos_ranges', nargs='+', type=float, default=None,
+                        help='cone angle ranges of the saved metrics, '
+                             'besides inter_pos_range (degrees)')
+    parser.add_argument('--seed', type=int, default=42,
+                        help='random seed, also of the random stream of every scene in categorization')
+    parser.add_argument('--processes', type=int, default=None,
+                        help='number of processes for categorization '
+                             '(default: 1, all cores with --goal_file)')
+    parser.add_argument('--cache_dir', default=None,
+                        help='cache parsed raw datasets in this directory')
+    parser.add_argument('--cache_max_size', type=float, default=10000,
+                        help='maximum size of the parse cache in MB')
+    parser.add_argument('--cache_max_age', type=float, default=30,
+                        help='remove parse cache entries unused for this many days')
 
     ## For Trajectory categorizing and filtering
     categorizers = parser.add_argument_group('categorizers')
@@ -244,47 +288,42 @@ def main():
 
     args = parser.parse_args()
     # Set Seed
-    random.seed(42)
-    np.random.seed(42)
+    random.seed(args.seed)
+    np.random.seed(args.seed)
 
-    sc = pysparkling.Context()
 
     # Real datasets conversion
     if not args.synthetic:
-        write(biwi(sc, 'data/raw/biwi/seq_hotel/obsmat.txt'),
-              'output_pre/{split}/biwi_hotel.ndjson', args)
-        categorize(sc, 'output_pre/{split}/biwi_hotel.ndjson', args)
-        write(crowds(sc, 'data/raw/crowds/crowds_zara01.vsp'),
-              'output_pre/{split}/crowds_zara01.ndjson', args)
-        categorize(sc, 'output_pre/{split}/crowds_zara01.ndjson', args)
-        write(crowds(sc, 'data/raw/crowds/crowds_zara03.vsp'),
-              'output_pre/{split}/crowds_zara03.ndjson', args)
-        categorize(sc, 'output_pre/{split}/crowds_zara03.ndjson', args)
-        write(crowds(sc, 'data/raw/crowds/students001.vsp'),
-              'output_pre/{split}/crowds_students001.ndjson', args)
-        categorize(sc, 'output_pre/{split}/crowds_students001.ndjson', args)
-        write(crowds(sc, 'data/raw/crowds/students003.vsp'),
-              'output_pre/{split}/crowds_students003.ndjson', args)
-        categorize(sc, 'output_pre/{split}/crowds_students003.ndjson', args)
+        write_and_categorize(biwi('data/raw/biwi/seq_hotel/obsmat.txt', args),
+                             'output_pre/{split}/biwi_hotel.ndjson', args)
+        write_and_categorize(crowds('data/raw/crowds/crowds_zara01.vsp', args),
+                             'output_pre/{split}/crowds_zara01.ndjson', args)
+        write_and_categorize(crowds('data/raw/crowds/crowds_zara03.vsp', args),
+                             'output_pre/{split}/crowds_zara03.ndjson', args)
+        write_and_categorize(crowds('data/raw/crowds/students001.vsp', args),
+                             'output_pre/{split}/crowds_students001.ndjson', args)
+        write_and_categorize(crowds('data/raw/crowds/students003.vsp', args),
+                             'output_pre/{split}/crowds_students003.ndjson', args)
 
         # # # new datasets
-        # write(lcas(sc, 'data/raw/lcas/test/data.csv'),
-        #       'output_pre/{split}/lcas.ndjson', args)
-        # categorize(sc, 'output_pre/{split}/lcas.ndjson', args)
+        # write_and_categorize(lcas('data/raw/lcas/test/data.csv', args),
+        #                      'output_pre/{split}/lcas.ndjson', args)
+
+        # # PETS09 S2L1 XML annotations
+        # write_and_categorize(mot_xml('data/raw/mot/PETS2009-S2L1.xml', args),
+        #                      'output_pre/{split}/pets2009_s2l1.ndjson', args)
 
         # args.fps = 2
-        # write(wildtrack(sc, 'data/raw/wildtrack/Wildtrack_dataset/annotations_positions/*.json'),
-        #       'output_pre/{split}/wildtrack.ndjson', args)
-        # categorize(sc, 'output_pre/{split}/wildtrack.ndjson', args)
+        # write_and_categorize(wildtrack('data/raw/wildtrack/Wildtrack_dataset/annotations_positions/*.json', args),
+        #                      'output_pre/{split}/wildtrack.ndjson', args)
         # args.fps = 2.5 # (Default)
 
         # # CFF: More trajectories
         # # Chunk_stride > 20 preferred & order_frames.
         # args.chunk_stride = 20
         # args.order_frames = True
-        # write(cff(sc, 'data/raw/cff_dataset/al_position2013-02-06.csv'),
-        #       'output_pre/{split}/cff_06.ndjson', args)
-        # categorize(sc, 'output_pre/{split}/cff_06.ndjson', args)
+        # write_and_categorize(cff('data/raw/cff_dataset/al_position2013-02-06.csv', args),
+        #                      'output_pre/{split}/cff_06.ndjson', args)
         # args.chunk_stride = 2 # (Default)
         # args.order_frames = False # (Default)
 
@@ -296,8 +335,7 @@ def main():
         assert args.orca_file is not None
         assert args.goal_file is not None
         assert args.output_filename is not None
-        write(controlled(sc, args.orca_file), 'output_pre/{split}/' + f'{args.output_filename}.ndjson', args)
-        categorize(sc, 'output_pre/{split}/' + f'{args.output_filename}.ndjson', args)
+        write_and_categorize(controlled(args.orca_file, args), 'output_pre/{split}/' + f'{args.output_filename}.ndjson', args)
         edit_goal_file(args.goal_file.split('/')[-1], f'{args.output_filename}.pkl')
 
     # Manual synthetic datasets conversion
@@ -305,9 +343,8 @@ def main():
         # Note: Generate Trajectories First! See command below
         ## 'python -m trajnetdataset.controlled_data <args>'
         print("Manual Synthetic Data Converion")
-        write(controlled(sc, 'data/raw/controlled/orca_circle_crossing_5ped_1000scenes_.txt'),
-              'output_pre/{split}/orca_five_synth.ndjson', args)
-        categorize(sc, 'output_pre/{split}/orca_five_synth.ndjson', args)
+        write_and_categorize(controlled('data/raw/controlled/orca_circle_crossing_5ped_1000scenes_.txt', args),
+                             'output_pre/{split}/orca_five_synth.ndjson', args)
         edit_goal_file('orca_circle_crossing_5ped_1000scenes_.pkl', 'orca_five_synth.pkl')
 
 if __name__ == '__main__':
@@ -1,25 +1,36 @@
 """ Categorization of Primary Pedestrian """
 
 import numpy as np
-import pysparkling
 
 import trajnetplusplustools
+from trajnetplusplustools import TrackRow
 from trajnetplusplustools.kalman import predict as kalman_predict
-from trajnetplusplustools.interactions import check_interaction, group
-from trajnetplusplustools.interactions import get_interaction_type
 
 import pickle
+from . import kalman
+from .interactions import interaction_types
 from .orca_helper import predict_all
+from .readers import parallel_map, trajnet_bulk
+from .sweep import scene_metrics, write_metrics
+from .tracks import as_tracks
+from .writers import write_scene_tensors, write_scenes
 
-def get_type(scene, args):
+def get_type(scene, args, primary_fde=None, interactions=None):
     '''
     Categorization of Single Scene
     :param scene: All trajectories as TrackRows, args
+    :param primary_fde: final displacement of the Kalman prediction of the
+                        primary pedestrian if already computed (see kalman_fde())
+    :param interactions: (Type III, interaction types) of the scene if already
+                         computed (see interactions.interaction_types())
     :return: The type of the traj
     '''
 
-    ## Get xy-coordinates from trackRows
-    scene_xy = trajnetplusplustools.Reader.paths_to_xy(scene)
+    ## Interaction test and types from one pass over the xy-coordinates
+    if interactions is None:
+        scene_xy = trajnetplusplustools.Reader.paths_to_xy(scene)
+        interactions = interaction_types([scene_xy], args)[0]
+    is_interaction, interaction_type = interactions
 
     ## Type 1
     def euclidean_distance(row1, row2):
@@ -31,18 +42,13 @@ def get_type(scene, args):
         '''
         return: True if the traj is linear according to Kalman
         '''
+        if primary_fde is not None:
+            ## the same random draws as the Kalman samples, to keep the random stream
+            np.random.standard_normal(kalman.n_draws(pred_len))
+            return primary_fde
         kalman_prediction, _ = kalman_predict(scene, obs_len, pred_len)[0]
         return trajnetplusplustools.metrics.final_l2(scene[0], kalman_prediction)
 
-    ## Type 3
-    def interaction(rows, pos_range, dist_thresh, obs_len):
-        '''
-        :return: Determine if interaction exists and type (optionally)
-        '''
-        interaction_matrix = check_interaction(rows, pos_range=pos_range, \
-                                 dist_thresh=dist_thresh, obs_len=obs_len)
-        return np.any(interaction_matrix)
-
     ## Category Tags
     mult_tag = []
     sub_tag = []
@@ -56,8 +62,7 @@ def get_type(scene, args):
         mult_tag.append(2)
 
     # Interactions
-    elif interaction(scene_xy, args.inter_pos_range, args.inter_dist_thresh, args.obs_len) \
-         or np.any(group(scene_xy, args.grp_dist_thresh, args.grp_std_thresh, args.obs_len)):
+    elif is_interaction:
         mult_tag.append(3)
 
     # Non-Linear (No explainable reason)
@@ -66,8 +71,7 @@ def get_type(scene, args):
 
     # Interaction Types
     if mult_tag[0] == 3:
-        sub_tag = get_interaction_type(scene_xy, args.inter_pos_range,
-                                       args.inter_dist_thresh, args.obs_len)
+        sub_tag = interaction_type
     else:
         sub_tag = []
 
@@ -123,22 +127,151 @@ def all_ped_present(scene):
     scene_xy = trajnetplusplustools.Reader.paths_to_xy(scene)
     return (not np.isnan(scene_xy).any())
 
-def write(rows, path, new_scenes, new_frames):
-    """ Writing scenes with categories """
-    output_path = path.replace('output_pre', 'output')
-    pysp_tracks = rows.filter(lambda r: r.frame in new_frames).map(trajnetplusplustools.writers.trajnet)
-    pysp_scenes = pysparkling.Context().parallelize(new_scenes).map(trajnetplusplustools.writers.trajnet)
-    pysp_scenes.union(pysp_tracks).saveAsTextFile(output_path)
+def scene_paths(rows, scene_rows):
+    """
+    Scenes as paths of TrackRows (primary pedestrian first), the same as
+    trajnetplusplustools.Reader(scene_type='paths') of the file written
+    from scene_rows and the Tracks rows, without the file.
+    TrackRows are only built for the rows of the frames of a scene, once
+    for overlapping scenes.
+    """
+    order, frames, bounds = rows.group_index('frame')
+    track_rows = [None] * len(rows)
+    built = np.zeros(len(rows), dtype=bool)
+    scenes = []
+    for scene in scene_rows:
+        start = bounds[np.searchsorted(frames, scene.start)]
+        end = bounds[np.searchsorted(frames, scene.end, side='right')]
+        index = order[start:end]
+        new = index[~built[index]]
+        if len(new):
+            for i, row in zip(new.tolist(), rows.filter(new).rows()):
+                track_rows[i] = row
+            built[new] = True
+        scenes.append(trajnetplusplustools.Reader.track_rows_to_paths(
+            scene.pedestrian, [track_rows[i] for i in index.tolist()]))
+    return scenes
+
+def categorize_scene(scene_task):
+    """
+    Categorize and filter one scene with its own random stream
+    The numpy random state drawn from for the acceptance, the ORCA noise
+    and the Kalman samples is seeded from args.seed and the scene id, so
+    the result does not depend on the order or on the process in which
+    the scenes are categorized.
+    :param scene_task: (scene id, paths of TrackRows or of row tuples from
+                       a process pool, ORCA goals or None,
+                       Kalman final displacement or None,
+                       (Type III, interaction types) or None, args)
+    :return: (status, tag, mult_tag, sub_tag) with status 'skipped',
+             'rejected', 'invalid' (not reproduced by ORCA) or 'accepted'
+    """
+    scene_id, scene, goals, fde, interactions, args = scene_task
+    if not isinstance(scene[0][0], TrackRow):
+        scene = [[TrackRow(*row) for row in path] for path in scene]
+    np.random.seed([args.seed, scene_id])
+
+    ## Check Collision
+    ## Used in CFF Datasets to account for imperfect tracking
+    # if check_collision(scene, args.pred_len):
+    #     return 'invalid', None, [], []
+
+    # ## Consider only those scenes where all pedestrians are present
+    # # Note: Different from removing incomplete trajectories
+    if args.all_present and (not all_ped_present(scene)):
+        return 'skipped', None, [], []
+
+    ## Get Tag
+    tag, mult_tag, sub_tag = get_type(scene, args, primary_fde=fde, interactions=interactions)
+
+    if np.random.uniform() >= args.acceptance[tag - 1]:
+        return 'rejected', tag, mult_tag, sub_tag
 
-def trajectory_type(rows, path, fps, track_id=0, args=None):
-    """ Categorization of all scenes """
+    ## Check Validity
+    ## Used in ORCA Datasets to account for rounding sensitivity
+    if goals is not None:
+        # print('Type III')
+        if orca_validity(scene, goals, args.pred_len, args.obs_len, args.mode):
+            return 'invalid', tag, mult_tag, sub_tag
+
+    return 'accepted', tag, mult_tag, sub_tag
+
+def kalman_fde(scenes, scene_rows, args, batch_size=4096):
+    """
+    Final displacement of the Kalman prediction of every primary pedestrian,
+    computed for batches of scenes with the random stream of every scene
+    in categorize_scene(). None for scenes too short for a prediction.
+    """
+    fde = [None] * len(scenes)
+    index = [i for i, scene in enumerate(scenes) if len(scene[0]) >= max(args.obs_len, 2)]
+    for start in range(0, len(index), batch_size):
+        batch = index[start:start + batch_size]
+        observations = np.array([[(row.x, row.y) for row in scenes[i][0][:args.obs_len]]
+                                 for i in batch])
+        final_positions = np.array([(scenes[i][0][-1].x, scenes[i][0][-1].y) for i in batch])
+        random_states = [np.random.RandomState([args.seed, scene_rows[i].scene]) for i in batch]
+        batch_fde = kalman.final_l2(observations, final_positions, args.pred_len, random_states)
+        for i, value in zip(batch, batch_fde.tolist()):
+            fde[i] = value
+    return fde
+
+def observed_xy(scene_test, args):
+    """
+    xy-coordinates of a public test scene in its observed frames, padded
+    with NaN to the obs_len + pred_len frames of the scene. Only the
+    pedestrians of the observed frames are kept: the public file can also
+    hold the observed frames of other scenes within the predicted frames.
+    """
+    observed = [scene_test[0][:args.obs_len]] + scene_test[1:]
+    xy = trajnetplusplustools.Reader.paths_to_xy(observed)
+    padded = np.full((args.obs_len + args.pred_len,) + xy.shape[1:], np.nan)
+    padded[:len(xy)] = xy
+    return padded
+
+def write(rows, path, new_scenes, new_frames, path_test=None, new_scenes_test=None,
+          new_frames_test=None):
+    """ Writing scenes with categories
+
+    The tracks of new_frames are taken from the frame index of rows.
+    With path_test, the public test scenes are written too, with the
+    tracks of new_frames_test taken from the same selection.
+    """
+    tracks = as_tracks(rows).in_frames(new_frames)
+    write_scenes(path.replace('output_pre', 'output'), new_scenes, tracks)
+    if path_test is not None:
+        write_scenes(path_test.replace('output_pre', 'output'), new_scenes_test,
+                     tracks.in_frames(new_frames_test))
+
+def write_tensors(path, new_scenes, new_xy):
+    """ Writing scenes with categories as scene tensors (.npy) """
+    output_path = path.replace('output_pre', 'output').split('.ndjson')[0] + '.npy'
+    write_scene_tensors(output_path, new_scenes, new_xy)
+
+def trajectory_type(rows, path, fps, track_id=0, args=None, scene_rows=None, test_rows=None):
+    """ Categorization of all scenes
+
+    The scenes are built from scene_rows and rows. Without scene_rows,
+    they are read from path. For the test set, the public test scenes
+    use test_rows, or the tracks of the public test file next to path.
+    path also names the output files. The scenes are categorized by
+    args.processes processes, by default one, or all cores with ORCA
+    validity, with the same result for any number of processes (see
+    categorize_scene). With args.tensors, the categorized
+    scenes are also written as scene tensors, the public test scenes with
+    their observed frames only (see observed_xy). With args.metrics, the
+    per-scene metrics of the categorization are saved for sweeps (see sweep).
+    """
+
+    rows = as_tracks(rows)
 
     ## Read
-    reader = trajnetplusplustools.Reader(path, scene_type='paths')
-    scenes = [s for _, s in reader.scenes()]
+    if scene_rows is None:
+        _, scene_rows = trajnet_bulk(path)
+    scenes = scene_paths(rows, scene_rows)
     ## Filtered Frames and Scenes
-    new_frames = set()
+    new_frames = []
     new_scenes = []
+    new_xy = []
 
     start_frames = set()
     ###########################################################################
@@ -148,11 +281,13 @@ def trajectory_type(rows, path, fps, track_id=0, args=None):
     test = 'test' in path
     if test:
         path_test = path.replace('test_private', 'test')
-        reader_test = trajnetplusplustools.Reader(path_test, scene_type='paths')
-        scenes_test = [s for _, s in reader_test.scenes()]
+        if test_rows is None:
+            test_rows, _ = trajnet_bulk(path_test)
+        scenes_test = scene_paths(as_tracks(test_rows), scene_rows)
         ## Filtered Test Frames and Test Scenes
-        new_frames_test = set()
+        new_frames_test = []
         new_scenes_test = []
+        new_xy_test = []
 
     ## For ORCA (Sensitivity)
     orca_sensitivity = False
@@ -170,7 +305,30 @@ def trajectory_type(rows, path, fps, track_id=0, args=None):
     if not scenes:
         raise Exception('No scenes found')
 
-    for index, scene in enumerate(scenes):
+    ## Type II and Type III tests of all scenes in batches
+    fde = kalman_fde(scenes, scene_rows, args)
+    scenes_xy = [trajnetplusplustools.Reader.paths_to_xy(scene) for scene in scenes]
+    interactions = interaction_types(scenes_xy, args)
+    if args.metrics:
+        if orca_sensitivity:
+            raise ValueError('metrics do not cover the ORCA validity of --goal_file')
+        write_metrics(path, scene_metrics(rows, scene_rows, scenes, scenes_xy, fde, fps, args))
+
+    ## Categorize the scenes in parallel, each with its own random stream
+    ## a pool only pays off for the expensive ORCA validity, unless asked for
+    processes = args.processes or (None if orca_sensitivity else 1)
+    pooled = processes != 1 and len(scenes) > 1
+    tasks = ((scene_row.scene,
+              [[tuple(row) for row in path] for path in scene] if pooled else scene,
+              [goal_dict[path[0].pedestrian] for path in scene] if orca_sensitivity else None,
+              scene_fde,
+              scene_interactions,
+              args)
+             for scene_row, scene, scene_fde, scene_interactions
+             in zip(scene_rows, scenes, fde, interactions))
+    results = parallel_map(categorize_scene, tasks, processes, n_tasks=len(scenes))
+
+    for index, (scene, (status, tag, mult_tag, sub_tag)) in enumerate(zip(scenes, results)):
         if (index+1) % 50 == 0:
             print(index)
 
@@ -186,66 +344,57 @@ def trajectory_type(rows, path, fps, track_id=0, args=None):
             assert len(scenes_test[index][0]) >= args.obs_len, \
                    'Scene Test not adequate length'
 
-        ## Check Collision
-        ## Used in CFF Datasets to account for imperfect tracking
-        # if check_collision(scene, args.pred_len):
-        #     col_count += 1
-        #     continue
-
-        # ## Consider only those scenes where all pedestrians are present
-        # # Note: Different from removing incomplete trajectories
-        if args.all_present and (not all_ped_present(scene)):
+        if status == 'invalid':
+            col_count += 1
+        if status != 'accepted':
             continue
 
-        ## Get Tag
-        tag, mult_tag, sub_tag = get_type(scene, args)
-
-        if np.random.uniform() < args.acceptance[tag - 1]:
-            ## Check Validity
-            ## Used in ORCA Datasets to account for rounding sensitivity
-            if orca_sensitivity:
-                goals = [goal_dict[path[0].pedestrian] for path in scene]
-                # print('Type III')
-                if orca_validity(scene, goals, args.pred_len, args.obs_len, args.mode):
-                    col_count += 1
-                    continue
-
-            ## Update Tags
-            tags[tag].append(track_id)
-            for tt in mult_tag:
-                mult_tags[tt].append(track_id)
-            for st in sub_tag:
-                sub_tags[st].append(track_id)
-
-            ## Define Scene_Tag
-            scene_tag = []
-            scene_tag.append(tag)
-            scene_tag.append(sub_tag)
-
-            ## Filtered scenes and Frames
-            # start_frames |= set(ped_interest[i].frame for i in range(len(ped_interest[0:1])))
-            # print(start_frames)
-            new_frames |= set(ped_interest[i].frame for i in range(len(ped_interest)))
-            new_scenes.append(
+        ## Update Tags
+        tags[tag].append(track_id)
+        for tt in mult_tag:
+            mult_tags[tt].append(track_id)
+        for st in sub_tag:
+            sub_tags[st].append(track_id)
+
+        ## Define Scene_Tag
+        scene_tag = []
+        scene_tag.append(tag)
+        scene_tag.append(sub_tag)
+
+        ## Filtered scenes and Frames
+        # start_frames |= set(ped_interest[i].frame for i in range(len(ped_interest[0:1])))
+        # print(start_frames)
+        new_frames += [row.frame for row in ped_interest]
+        new_scenes.append(
+            trajnetplusplustools.data.SceneRow(track_id, ped_interest[0].pedestrian,
+                                       ped_interest[0].frame, ped_interest[-1].frame,
+                                       fps, scene_tag))
+        if args.tensors:
+            new_xy.append(scenes_xy[index])
+            if test:
+                new_xy_test.append(observed_xy(scenes_test[index], args))
+
+        ## Append to list of scenes_test as well if Test Set
+        if test:
+            new_frames_test += [row.frame for row in ped_interest[:args.obs_len]]
+            new_scenes_test.append(
                 trajnetplusplustools.data.SceneRow(track_id, ped_interest[0].pedestrian,
                                            ped_interest[0].frame, ped_interest[-1].frame,
-                                           fps, scene_tag))
-
-            ## Append to list of scenes_test as well if Test Set
-            if test:
-                new_frames_test |= set(ped_interest[i].frame for i in range(args.obs_len))
-                new_scenes_test.append(
-                    trajnetplusplustools.data.SceneRow(track_id, ped_interest[0].pedestrian,
-                                               ped_interest[0].frame, ped_interest[-1].frame,
-                                               fps, 0))
+                                           fps, 0))
 
-            track_id += 1
+        track_id += 1
 
 
     # Writes the Final Scenes and Frames
-    write(rows, path, new_scenes, new_frames)
     if test:
-        write(rows, path_test, new_scenes_test, new_frames_test)
+        write(rows, path, new_scenes, new_frames, path_test, new_scenes_test, new_frames_test)
+    else:
+        write(rows, path, new_scenes, new_frames)
+
+    if args.tensors:
+        write_tensors(path, new_scenes, new_xy)
+        if test:
+            write_tensors(path_test, new_scenes_test, new_xy_test)
 
     ## Stats
 
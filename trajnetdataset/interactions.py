@@ -0,0 +1,192 @@
+""" Batched interaction categorization of scenes
+
+The Type III test and the interaction types (LF, CA, Group, Others) of
+get_type, as in trajnetplusplustools.interactions, computed for a stack
+of scenes at once. Scenes are (frames, pedestrians, 2) arrays with the
+primary pedestrian first, padded with NaN to (scenes, frames, max_peds, 2).
+Missing positions are NaN and never count as an interaction.
+"""
+
+from collections import defaultdict
+
+import numpy as np
+
+## interaction types
+LEADER_FOLLOWER = 1
+COLLISION_AVOIDANCE = 2
+GROUP = 3
+OTHERS = 4
+
+
+def pad(scenes_xy):
+    """Stack scenes of the same number of frames, padded with NaN pedestrians."""
+    max_peds = max(xy.shape[1] for xy in scenes_xy)
+    padded = np.full((len(scenes_xy), len(scenes_xy[0]), max_peds, 2), np.nan)
+    for i, xy in enumerate(scenes_xy):
+        padded[i, :, :xy.shape[1]] = xy
+    return padded
+
+
+def relative_angle(vector, primary_angle):
+    """Angle of vector relative to primary_angle in degrees, in [0, 360)."""
+    angle = np.arctan2(vector[..., 1], vector[..., 0])
+    return ((angle - primary_angle[..., None]) * 180 / np.pi) % 360
+
+
+def cone(theta, dist, angle, angle_range, dist_thresh):
+    """Neighbours within dist_thresh and in the cone of angle +- angle_range."""
+    angle_low = angle - angle_range
+    angle_high = angle + angle_range
+    if angle_high > 360:
+        raise ValueError
+    if angle_low < 0:
+        theta = np.where(theta > 180, theta - 360, theta)
+    return (angle_low < theta) & (theta <= angle_high) & (dist < dist_thresh)
+
+
+def geometry(xy, obs_len, stride=3):
+    """Relative angles and distances of the neighbours of padded scenes.
+
+    :return: (theta_position, theta_velocity, dist) of the neighbours
+             after obs_len, relative to the primary pedestrian and of
+             shape (scenes, frames - obs_len, max_peds - 1), and
+             (side, mean_dist, std_dist) of shape (scenes, max_peds - 1)
+             for groups: whether a neighbour is ever on the side of the
+             primary pedestrian, and its mean and std distance over all
+             frames
+    """
+    path = xy[:, :, 0]
+    neigh_path = xy[:, :, 1:]
+
+    ## primary velocity, positions and velocities of the neighbours relative to it
+    primary_velocity = path[:, obs_len:] - path[:, obs_len-stride:-stride]
+    primary_angle = np.arctan2(primary_velocity[..., 1], primary_velocity[..., 0])
+    relative_position = neigh_path[:, obs_len:] - path[:, obs_len:, np.newaxis, :]
+    neigh_velocity = neigh_path[:, obs_len:] - neigh_path[:, obs_len-stride:-stride]
+    theta_position = relative_angle(relative_position, primary_angle)
+    theta_velocity = relative_angle(neigh_velocity, primary_angle)
+    dist = np.linalg.norm(relative_position, axis=3)
+
+    ## groups: neighbours on the side keeping a constant distance
+    side = np.any(cone(theta_position, dist, 90, 45, 5) | cone(theta_position, dist, 270, 45, 5),
+                  axis=1)
+    dist_all = np.linalg.norm((neigh_path - path[:, :, np.newaxis, :]), axis=3)
+    mean_dist = np.mean(dist_all, axis=1)
+    std_dist = np.std(dist_all, axis=1)
+    return theta_position, theta_velocity, dist, side, mean_dist, std_dist
+
+
+def scene_interactions(xy, args):
+    """Type III test and interaction types of padded scenes.
+
+    The relative angles and distances to the neighbours are computed once
+    and shared by all tests.
+
+    :param xy: (scenes, frames, max_peds, 2) array
+    :return: (interaction, types) with interaction a boolean array of the
+             Type III test and types a boolean (scenes, 4) array of the
+             interaction types 1 to 4
+    """
+    theta_position, theta_velocity, dist, side, mean_dist, std_dist = geometry(xy, args.obs_len)
+
+    def group(dist_thresh, std_thresh):
+        return np.any((mean_dist < dist_thresh) & (std_dist < std_thresh) & side, axis=1)
+
+    ## neighbours in front of the primary pedestrian
+    front = cone(theta_position, dist, 0, args.inter_pos_range, args.inter_dist_thresh)
+    interaction = np.any(front, axis=(1, 2)) | group(args.grp_dist_thresh, args.grp_std_thresh)
+
+    types = np.zeros((len(xy), 4), dtype=bool)
+    same_direction = cone(theta_velocity, dist, 0, 15, args.inter_dist_thresh)
+    types[:, LEADER_FOLLOWER - 1] = np.any(np.sum(front & same_direction, axis=1) >= 5, axis=1)
+    opposite_direction = cone(theta_velocity, dist, 180, 15, args.inter_dist_thresh)
+    types[:, COLLISION_AVOIDANCE - 1] = np.any(front & opposite_direction, axis=(1, 2))
+    types[:, GROUP - 1] = group(0.8, 0.2)
+    types[:, OTHERS - 1] = ~np.any(types[:, :3], axis=1)
+    return interaction, types
+
+
+def scene_interaction_metrics(xy, args, pos_ranges):
+    """Distances behind the Type III test and the interaction types of padded scenes.
+
+    For every angle range of pos_ranges, the smallest distance of a
+    neighbour in front (Type III), the smallest distance at which a
+    neighbour is in front and walks in the same direction in 5 frames
+    (LF) and the smallest distance of a neighbour in front walking in the
+    opposite direction (CA). A test passes for a distance threshold above
+    its distance, so one set of distances serves all distance thresholds.
+
+    :return: (front, leader_follower, collision_avoidance) arrays of shape
+             (scenes, len(pos_ranges)), and (side, mean_dist, std_dist)
+             as in geometry()
+    """
+    theta_position, theta_velocity, dist, side, mean_dist, std_dist = geometry(xy, args.obs_len)
+    same_direction = cone(theta_velocity, dist, 0, 15, np.inf)
+    opposite_direction = cone(theta_velocity, dist, 180, 15, np.inf)
+
+    front_dist = np.full((len(xy), len(pos_ranges)), np.inf)
+    leader_follower_dist = np.full((len(xy), len(pos_ranges)), np.inf)
+    collision_avoidance_dist = np.full((len(xy), len(pos_ranges)), np.inf)
+    for r, pos_range in enumerate(pos_ranges):
+        front = cone(theta_position, dist, 0, pos_range, np.inf)
+        front_dist[:, r] = np.min(np.where(front, dist, np.inf), axis=(1, 2), initial=np.inf)
+        if dist.shape[1] >= 5:
+            fifth_dist = np.sort(np.where(front & same_direction, dist, np.inf), axis=1)[:, 4]
+            leader_follower_dist[:, r] = np.min(fifth_dist, axis=1, initial=np.inf)
+        collision_avoidance_dist[:, r] = np.min(np.where(front & opposite_direction, dist, np.inf),
+                                                axis=(1, 2), initial=np.inf)
+    return (front_dist, leader_follower_dist, collision_avoidance_dist,
+            side, mean_dist, std_dist)
+
+
+def in_batches(function, scenes_xy, batch_size=1024):
+    """Results of function on padded batches of scenes_xy, in the order of the scenes.
+
+    Scenes of the same number of frames are stacked in batches of
+    batch_size. function returns one result per scene of a batch.
+    """
+    results = [None] * len(scenes_xy)
+    by_n_frames = defaultdict(list)
+    for i, xy in enumerate(scenes_xy):
+        by_n_frames[len(xy)].append(i)
+    for index in by_n_frames.values():
+        for start in range(0, len(index), batch_size):
+            batch = index[start:start + batch_size]
+            for i, result in zip(batch, function(pad([scenes_xy[i] for i in batch]))):
+                results[i] = result
+    return results
+
+
+def interaction_types(scenes_xy, args, batch_size=1024):
+    """Type III test and list of interaction types for every scene."""
+    def batch_types(xy):
+        interaction, types = scene_interactions(xy, args)
+        return [(scene_interaction, (np.flatnonzero(scene_types) + 1).tolist())
+                for scene_interaction, scene_types in zip(interaction.tolist(), types)]
+    return in_batches(batch_types, scenes_xy, batch_size)
+
+
+def interaction_metrics(scenes_xy, args, pos_ranges, batch_size=1024):
+    """Interaction metrics of every scene (see scene_interaction_metrics()).
+
+    :return: (front, leader_follower, collision_avoidance) arrays of
+             shape (scenes, len(pos_ranges)) and the mean and std
+             distance of the neighbours on the side of every scene, as
+             arrays of all scenes with the offsets of every scene
+    """
+    def batch_metrics(xy):
+        front, leader_follower, collision_avoidance, side, mean_dist, std_dist = \
+            scene_interaction_metrics(xy, args, pos_ranges)
+        group = side & np.isfinite(mean_dist) & np.isfinite(std_dist)
+        return [(front[i], leader_follower[i], collision_avoidance[i],
+                 mean_dist[i][group[i]], std_dist[i][group[i]]) for i in range(len(xy))]
+
+    metrics = in_batches(batch_metrics, scenes_xy, batch_size)
+    front, leader_follower, collision_avoidance = (
+        np.array([m[k] for m in metrics]).reshape(-1, len(pos_ranges)) for k in range(3))
+    group_mean = [m[3] for m in metrics]
+    group_std = [m[4] for m in metrics]
+    group_offsets = np.cumsum([0] + [len(m) for m in group_mean])
+    return (front, leader_follower, collision_avoidance,
+            np.concatenate([np.zeros(0)] + group_mean), np.concatenate([np.zeros(0)] + group_std),
+            group_offsets)
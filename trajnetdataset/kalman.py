@@ -0,0 +1,188 @@
+""" Batched Kalman prediction of primary pedestrians
+
+The constant velocity model of trajnetplusplustools.kalman.predict, with
+the EM, smoothing and sampling of pykalman.KalmanFilter, computed for a
+stack of scenes at once. Scenes are the first axis of all arrays.
+"""
+
+import numpy as np
+
+TRANSITION = np.array([[1, 1, 0, 0],
+                       [0, 1, 0, 0],
+                       [0, 0, 1, 1],
+                       [0, 0, 0, 1]], dtype=np.float64)
+OBSERVATION = np.array([[1, 0, 0, 0],
+                        [0, 0, 1, 0]], dtype=np.float64)
+N_EM_ITER = 10
+N_SAMPLES = 5
+
+
+def n_draws(pred_len):
+    """Number of standard normal draws of the sampled predictions of a scene."""
+    return N_SAMPLES * (2 + pred_len * 6)
+
+
+def pinv(a):
+    """Pseudo-inverse of stacked matrices, with the cutoff of scipy.linalg.pinv."""
+    u, s, vh = np.linalg.svd(a, full_matrices=False)
+    cutoff = s.max(axis=-1, keepdims=True) * max(a.shape[-2:]) * np.finfo(a.dtype).eps
+    u = u / np.where(s > cutoff, s, np.inf)[..., None, :]
+    return np.swapaxes(u @ vh, -1, -2)
+
+
+def outer(a, b):
+    return a[..., :, None] * b[..., None, :]
+
+
+def kalman_filter(observations, transition_covariance, observation_covariance,
+                  initial_state_mean, initial_state_covariance):
+    """Kalman filter, returns the predicted and filtered means and covariances."""
+    n_timesteps = observations.shape[1]
+    predicted_means, predicted_covariances = [], []
+    filtered_means, filtered_covariances = [], []
+    for t in range(n_timesteps):
+        if t == 0:
+            predicted_mean = initial_state_mean
+            predicted_covariance = initial_state_covariance
+        else:
+            predicted_mean = filtered_means[-1] @ TRANSITION.T
+            predicted_covariance = (TRANSITION @ (filtered_covariances[-1] @ TRANSITION.T)
+                                    + transition_covariance)
+
+        predicted_observation_mean = predicted_mean @ OBSERVATION.T
+        ## covariance of the innovation, the observation minus its prediction
+        innovation_cov = (OBSERVATION @ (predicted_covariance @ OBSERVATION.T)
+                          + observation_covariance)
+        kalman_gain = predicted_covariance @ (OBSERVATION.T @ pinv(innovation_cov))
+        filtered_mean = predicted_mean + (
+            kalman_gain @ (observations[:, t] - predicted_observation_mean)[..., None])[..., 0]
+        filtered_covariance = (predicted_covariance
+                               - kalman_gain @ (OBSERVATION @ predicted_covariance))
+
+        predicted_means.append(predicted_mean)
+        predicted_covariances.append(predicted_covariance)
+        filtered_means.append(filtered_mean)
+        filtered_covariances.append(filtered_covariance)
+    return predicted_means, predicted_covariances, filtered_means, filtered_covariances
+
+
+def kalman_smoother(predicted_means, predicted_covariances, filtered_means, filtered_covariances):
+    """Kalman smoother, returns the smoothed means, covariances and the smoothing gains."""
+    n_timesteps = len(filtered_means)
+    smoothed_means = [None] * n_timesteps
+    smoothed_covariances = [None] * n_timesteps
+    gains = [None] * (n_timesteps - 1)
+    smoothed_means[-1] = filtered_means[-1]
+    smoothed_covariances[-1] = filtered_covariances[-1]
+    for t in reversed(range(n_timesteps - 1)):
+        gain = filtered_covariances[t] @ (TRANSITION.T @ pinv(predicted_covariances[t + 1]))
+        smoothed_means[t] = filtered_means[t] + (
+            gain @ (smoothed_means[t + 1] - predicted_means[t + 1])[..., None])[..., 0]
+        smoothed_covariances[t] = filtered_covariances[t] + gain @ (
+            (smoothed_covariances[t + 1] - predicted_covariances[t + 1])
+            @ np.swapaxes(gain, -1, -2))
+        gains[t] = gain
+    return smoothed_means, smoothed_covariances, gains
+
+
+def smooth(observations, parameters):
+    """Smoothed state means and covariances, and the smoothing gains."""
+    return kalman_smoother(*kalman_filter(observations, *parameters))
+
+
+def em(observations, parameters, n_iter=N_EM_ITER):
+    """EM of the transition and observation covariances and of the initial state,
+    the default em_vars of pykalman.KalmanFilter."""
+    n_timesteps = observations.shape[1]
+    for _ in range(n_iter):
+        means, covariances, gains = smooth(observations, parameters)
+        pairwise_covariances = [None] + [covariances[t] @ np.swapaxes(gains[t - 1], -1, -2)
+                                         for t in range(1, n_timesteps)]
+
+        observation_covariance = 0.0
+        for t in range(n_timesteps):
+            err = observations[:, t] - means[t] @ OBSERVATION.T
+            observation_covariance = observation_covariance + (
+                outer(err, err) + OBSERVATION @ (covariances[t] @ OBSERVATION.T))
+        observation_covariance = (1.0 / n_timesteps) * observation_covariance
+
+        transition_covariance = 0.0
+        for t in range(n_timesteps - 1):
+            err = means[t + 1] - means[t] @ TRANSITION.T
+            pairwise_transition = pairwise_covariances[t + 1] @ TRANSITION.T
+            transition_covariance = transition_covariance + (
+                outer(err, err)
+                + TRANSITION @ (covariances[t] @ TRANSITION.T)
+                + covariances[t + 1]
+                - pairwise_transition
+                - np.swapaxes(pairwise_transition, -1, -2))
+        transition_covariance = (1.0 / (n_timesteps - 1)) * transition_covariance
+
+        initial_state_mean = means[0]
+        initial_state_covariance = (covariances[0] + outer(means[0], means[0])
+                                    - outer(initial_state_mean, means[0])
+                                    - outer(means[0], initial_state_mean)
+                                    + outer(initial_state_mean, initial_state_mean))
+
+        parameters = (transition_covariance, observation_covariance,
+                      initial_state_mean, initial_state_covariance)
+    return parameters
+
+
+def noise_transform(covariance):
+    """Transform of standard normal draws by multivariate_normal of RandomState."""
+    _, s, v = np.linalg.svd(covariance)
+    return np.sqrt(s)[..., :, None] * v
+
+
+def predict(observations, pred_len, random_states):
+    """Average of the sampled predictions after the observations.
+
+    :param observations: (scenes, obs_len, 2) array of primary positions
+    :param random_states: one numpy RandomState per scene, the sampling
+        noise is drawn from it exactly as in pykalman.KalmanFilter.sample
+    :return: (scenes, pred_len, 2) array of predicted positions
+    """
+    n_scenes = len(observations)
+    initial_state_mean = np.zeros((n_scenes, 4))
+    initial_state_mean[:, 0] = observations[:, 0, 0]
+    initial_state_mean[:, 2] = observations[:, 0, 1]
+    parameters = (np.broadcast_to(1e-5 * np.eye(4), (n_scenes, 4, 4)),
+                  np.broadcast_to(0.05**2 * np.eye(2), (n_scenes, 2, 2)),
+                  initial_state_mean,
+                  np.broadcast_to(np.eye(4), (n_scenes, 4, 4)))
+
+    parameters = em(observations, parameters)
+    means, _, _ = smooth(observations, parameters)
+    transition_noise = noise_transform(parameters[0])
+    observation_noise = noise_transform(parameters[1])
+
+    ## per sample: observation noise at t=0, then transition and observation noise
+    draws = np.stack([random_state.standard_normal(n_draws(pred_len))
+                      for random_state in random_states]).reshape(n_scenes, N_SAMPLES, -1)
+    predictions = 0.0
+    for sample in range(N_SAMPLES):
+        state = means[-1]
+        observation_draws = [draws[:, sample, 0:2]]
+        transition_draws = []
+        for t in range(1, pred_len + 1):
+            offset = 2 + (t - 1) * 6
+            transition_draws.append(draws[:, sample, offset:offset + 4])
+            observation_draws.append(draws[:, sample, offset + 4:offset + 6])
+
+        sampled = []
+        for t in range(pred_len + 1):
+            if t > 0:
+                state = state @ TRANSITION.T + (
+                    transition_draws[t - 1][:, None, :] @ transition_noise)[:, 0]
+            sampled.append(state @ OBSERVATION.T + (
+                observation_draws[t][:, None, :] @ observation_noise)[:, 0])
+        predictions = predictions + np.stack(sampled, axis=1)
+    predictions = predictions / float(N_SAMPLES)
+    return predictions[:, 1:]
+
+
+def final_l2(observations, final_positions, pred_len, random_states):
+    """Final displacement between the prediction and final_positions, per scene."""
+    predictions = predict(observations, pred_len, random_states)
+    return np.linalg.norm(predictions[:, -1] - final_positions, axis=1)
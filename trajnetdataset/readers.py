@@ -1,13 +1,114 @@
 """ Read Raw files as TrackRows """
 
+import collections
 import json
+import mmap
+import multiprocessing
 import os
+import re
 import xml.etree.ElementTree
 
 import numpy as np
 import scipy.interpolate
+import scipy.io
+import scipy.sparse
+import scipy.sparse.linalg
 
-from trajnetplusplustools import TrackRow
+from trajnetplusplustools import SceneRow, TrackRow
+
+from . import archives
+from .tracks import Tracks
+
+
+def read_text(file_name):
+    return archives.read_text(file_name)
+
+
+def parallel_map(function, tasks, processes=None, n_tasks=None, max_pending=None):
+    """Map over a process pool, keeping the order of tasks.
+
+    tasks can also be a generator, but the pool takes all of its tasks
+    at once. With max_pending, at most max_pending tasks are taken from
+    tasks before their results are collected, so that large tasks are
+    not all held in memory.
+    Otherwise, tasks are sent to the workers in chunks of about a
+    quarter of the tasks of a worker, from len(tasks) or n_tasks, so
+    that small tasks are not dominated by the pickling of every single
+    task.
+    Runs in the current process when there is a single process or task.
+    """
+    processes = processes or os.cpu_count() or 1
+    if n_tasks is None and isinstance(tasks, (list, tuple)):
+        n_tasks = len(tasks)
+    if processes == 1 or (n_tasks is not None and n_tasks <= 1):
+        return list(map(function, tasks))
+
+    with multiprocessing.Pool(processes) as pool:
+        if max_pending is None:
+            chunksize = max(1, (n_tasks or 0) // (4 * processes))
+            return list(pool.imap(function, tasks, chunksize))
+
+        results = []
+        pending = collections.deque()
+        for task in tasks:
+            if len(pending) >= max_pending:
+                results.append(pending.popleft().get())
+            pending.append(pool.apply_async(function, (task,)))
+        results.extend(result.get() for result in pending)
+        return results
+
+
+def read_file_tracks(reader_file_index):
+    reader, (file_name, content), index = reader_file_index
+    if content is None:
+        content = read_text(file_name)
+    filename_content = (file_name, content)
+    if index is not None:
+        filename_content = (filename_content, index)
+    return Tracks.from_rows(reader(filename_content))
+
+
+def files_parallel(pattern, reader, processes=None, with_index=False, keep=None):
+    """Read and parse many files in a process pool.
+
+    reader gets (file_name, content) pairs like from wholeTextFiles() or,
+    with_index, ((file_name, content), index) pairs like from
+    wholeTextFiles().zipWithIndex(). Files are indexed and concatenated
+    in sorted order, so the result does not depend on the number of
+    processes. keep is an optional predicate on the file names.
+
+    Plain files are read by the workers. Files in an archive are read
+    in one sequential pass over the archive and only parsed by the
+    workers.
+    """
+    if archives.split(pattern)[0] is None:
+        files = [(file_name, None) for file_name in archives.glob(pattern)
+                 if keep is None or keep(file_name)]
+    else:
+        files = archives.read_files(pattern, keep)
+    tasks = [(reader, file_name_content, index if with_index else None)
+             for index, file_name_content in enumerate(files)]
+    return Tracks.concatenate(parallel_map(read_file_tracks, tasks, processes))
+
+
+def read_columns(input_file, delimiter=None, usecols=(0, 1, 2, 3), frame_offset=0,
+                 frame_stride=1):
+    """Bulk reader for delimited text files.
+
+    Parses the whole file in one vectorized pass into Tracks.
+    The columns in usecols are frame, pedestrian, x and y.
+    A delimiter of None splits on any whitespace.
+    Only frames that are a multiple of frame_stride are kept.
+    """
+    with archives.open_text(input_file) as f:
+        data = np.loadtxt(f, delimiter=delimiter, usecols=usecols, ndmin=2)
+    tracks = Tracks((data[:, 0] + frame_offset).astype(np.int64),
+                    data[:, 1].astype(np.int64),
+                    data[:, 2],
+                    data[:, 3])
+    if frame_stride != 1:
+        tracks = tracks.filter(tracks.frame % frame_stride == 0)
+    return tracks
 
 
 def biwi(line):
@@ -17,6 +118,10 @@ def biwi(line):
                     float(line[2]),
                     float(line[4]))
 
+
+def biwi_bulk(input_file):
+    return read_columns(input_file, usecols=(0, 1, 2, 4), frame_offset=-1)
+
 def crowds_interpolate_person(ped_id, person_xyf):
     ## Earlier
     # xs = np.array([x for x, _, _ in person_xyf]) / 720 * 12 # 0.0167
@@ -41,7 +146,103 @@ def crowds_interpolate_person(ped_id, person_xyf):
             for x, y, f in np.stack([x_fn(frames), y_fn(frames), frames]).T]
 
 
-def crowds(whole_file):
+def crowds_interpolate(pedestrians):
+    """Interpolate all pedestrians on the 10-frame grid at once.
+
+    Batched version of crowds_interpolate_person(): pedestrians with more
+    than 5 control points get a not-a-knot cubic spline (as interp1d
+    kind='cubic'), the others linear interpolation. The spline equations
+    of all pedestrians are solved as one sparse block-diagonal system and
+    all grid frames are evaluated together. Results agree with interp1d
+    up to floating point rounding.
+
+    :return: Tracks
+    """
+    if not pedestrians:
+        return Tracks.empty()
+
+    lengths = np.array([len(p) for p in pedestrians], dtype=np.int64)
+    ped = np.repeat(np.arange(len(pedestrians)), lengths)
+    points = np.array([xyf for p in pedestrians for xyf in p], dtype=np.float64)
+
+    # sort control points by frame within each pedestrian
+    order = np.lexsort((points[:, 2], ped))
+    ped = ped[order]
+    fs = points[order, 2]
+    xy = points[order, :2] * (0.0210, 0.0239)
+    starts = np.cumsum(lengths) - lengths
+    ends = starts + lengths
+
+    # 10-frame grid of each pedestrian
+    grid_start = fs[starts].astype(np.int64) // 10 * 10 + 10
+    n_grid = np.maximum(0, (fs[ends - 1].astype(np.int64) - grid_start + 9) // 10)
+    grid_ped = np.repeat(np.arange(len(pedestrians)), n_grid)
+    grid_offset = np.cumsum(n_grid) - n_grid
+    frames = grid_start[grid_ped] + 10 * (np.arange(len(grid_ped)) - grid_offset[grid_ped])
+
+    # segment of every grid frame
+    span = int(fs.max() - fs.min()) + 1
+    knot_keys = ped * span + (fs - fs.min()).astype(np.int64)
+    frame_keys = grid_ped * span + (frames - int(fs.min()))
+    hi = np.searchsorted(knot_keys, frame_keys, side='left')
+    hi = np.clip(hi, starts[grid_ped] + 1, ends[grid_ped] - 1)
+    lo = hi - 1
+    h = (fs[hi] - fs[lo])[:, np.newaxis]
+    t_lo = (frames - fs[lo])[:, np.newaxis]
+    t_hi = (fs[hi] - frames)[:, np.newaxis]
+
+    # linear
+    result = (xy[hi] - xy[lo]) / h * t_lo + xy[lo]
+
+    # cubic: solve for the second derivatives m at the control points
+    cubic = lengths > 5
+    if np.any(cubic):
+        n_points = len(fs)
+        # differences across pedestrian boundaries are never used
+        dfs = np.diff(fs, append=fs[-1] + 1.0)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            slopes = np.diff(xy, axis=0, append=xy[-1:]) / dfs[:, np.newaxis]
+        in_cubic = cubic[ped]
+        first = starts[cubic]
+        last = ends[cubic] - 1
+        inner = np.flatnonzero(in_cubic)
+        inner = inner[~np.isin(inner, np.concatenate((first, last)))]
+        identity = np.flatnonzero(~in_cubic)
+
+        rows = np.concatenate((identity,
+                               np.repeat(inner, 3), np.repeat(first, 3), np.repeat(last, 3)))
+        cols = np.concatenate((identity,
+                               np.stack((inner - 1, inner, inner + 1), axis=1).ravel(),
+                               np.stack((first, first + 1, first + 2), axis=1).ravel(),
+                               np.stack((last - 2, last - 1, last), axis=1).ravel()))
+        values = np.concatenate((
+            np.ones(len(identity)),
+            np.stack((dfs[inner - 1], 2.0 * (dfs[inner - 1] + dfs[inner]), dfs[inner]),
+                     axis=1).ravel(),
+            # not-a-knot: continuous third derivative at the second and
+            # second-to-last control points
+            np.stack((dfs[first + 1], -(dfs[first] + dfs[first + 1]), dfs[first]),
+                     axis=1).ravel(),
+            np.stack((dfs[last - 1], -(dfs[last - 2] + dfs[last - 1]), dfs[last - 2]),
+                     axis=1).ravel(),
+        ))
+        rhs = np.zeros((n_points, 2))
+        rhs[inner] = 6.0 * (slopes[inner] - slopes[inner - 1])
+        system = scipy.sparse.csc_matrix((values, (rows, cols)), shape=(n_points, n_points))
+        m = scipy.sparse.linalg.spsolve(system, rhs).reshape(n_points, 2)
+
+        spline = (m[lo] * t_hi ** 3 / (6.0 * h) + m[hi] * t_lo ** 3 / (6.0 * h)
+                  + (xy[lo] / h - m[lo] * h / 6.0) * t_hi
+                  + (xy[hi] / h - m[hi] * h / 6.0) * t_lo)
+        # control points are interpolated exactly
+        spline = np.where(t_lo == 0, xy[lo], spline)
+        result = np.where(cubic[grid_ped][:, np.newaxis], spline, result)
+
+    return Tracks(frames, grid_ped, result[:, 0], result[:, 1])
+
+
+def crowds_control_points(whole_file):
+    """Parse the control points [x, y, frame] of every pedestrian."""
     pedestrians = []
     current_pedestrian = []
     for line in whole_file.split('\n'):
@@ -67,30 +268,64 @@ def crowds(whole_file):
     if current_pedestrian:
         pedestrians.append(current_pedestrian)
 
-    return [row
-            for i, p in enumerate(pedestrians)
-            for row in crowds_interpolate_person(i, p)]
+    return pedestrians
+
+
+def crowds_bulk(whole_file):
+    return crowds_interpolate(crowds_control_points(whole_file))
+
+
+def crowds(whole_file):
+    return list(crowds_bulk(whole_file).rows())
 
 
-def mot_xml(file_name):
+def crowds_files(pattern):
+    return Tracks.concatenate(crowds_bulk(content)
+                              for _, content in archives.read_files(pattern))
+
+
+def mot_xml(file_name, frame_stride=2):
     """PETS2009 dataset.
 
     Original frame rate is 7 frames / sec.
+
+    The XML is parsed incrementally. Every <frame> element is removed
+    from the tree once its rows are emitted, so memory does not grow
+    with the length of the annotation.
     """
-    tree = xml.etree.ElementTree.parse(file_name)
-    root = tree.getroot()
-    for frame in root:
-        f = int(frame.attrib['number'])
-        if f % 2 != 0:  # reduce to 3.5 rows / sec
+    with archives.open_binary(file_name) as f:
+        yield from mot_xml_frames(f, frame_stride)
+
+
+def mot_xml_frames(xml_file, frame_stride):
+    depth = 0
+    root = None
+    for event, element in xml.etree.ElementTree.iterparse(xml_file, events=('start', 'end')):
+        if event == 'start':
+            depth += 1
+            if root is None:
+                root = element
             continue
 
-        for ped in frame.find('objectlist'):
-            p = ped.attrib['id']
-            box = ped.find('box')
-            x = box.attrib['xc']
-            y = box.attrib['yc']
+        depth -= 1
+        if depth != 1:  # only complete children of the root are frames
+            continue
+
+        f = int(element.attrib['number'])
+        if f % frame_stride == 0:  # reduce to 3.5 rows / sec
+            for ped in element.find('objectlist'):
+                p = ped.attrib['id']
+                box = ped.find('box')
+                x = box.attrib['xc']
+                y = box.attrib['yc']
+
+                yield TrackRow(f, int(p), float(x) / 100.0, float(y) / 100.0)
+
+        root.clear()
 
-            yield TrackRow(f, int(p), float(x) / 100.0, float(y) / 100.0)
+
+def mot_xml_bulk(file_name, frame_stride=2):
+    return Tracks.from_rows(mot_xml(file_name, frame_stride))
 
 
 def mot(line):
@@ -106,10 +341,15 @@ def mot(line):
                     float(line[8]))
 
 
-def edinburgh(filename_content_index):
+def mot_bulk(input_file, frame_stride=1):
+    return read_columns(input_file, delimiter=',', usecols=(0, 1, 7, 8),
+                        frame_stride=frame_stride)
+
+
+def edinburgh(filename_content_index, frame_stride=3):
     """Edinburgh Informatics Forum data reader.
 
-    Original frame rate is 9fps.
+    Original frame rate is 9fps and is downsampled by frame_stride.
     Every pixel corresponds to 24.7mm.
     http://homepages.inf.ed.ac.uk/rbf/FORUMTRACKING/
     """
@@ -129,10 +369,12 @@ def edinburgh(filename_content_index):
         for coordinates in coordinates.split(';'):
             if not coordinates:
                 continue
-            x, y, frame = coordinates.strip('[] ').split(' ')
+            # check the frame before parsing the coordinates
+            xy, _, frame = coordinates.strip('[] ').rpartition(' ')
             frame = int(frame) + index * 1000000
-            if frame % 3 != 0:  # downsample frame rate
+            if frame % frame_stride != 0:  # downsample frame rate
                 continue
+            x, y = xy.split(' ')
             yield TrackRow(frame, track_id, float(x) * 0.0247, float(y) * 0.0247)
 
 
@@ -175,26 +417,56 @@ def syi(filename_content):
         last_row = new_row
 
 
-def dukemtmc(input_array, query_camera=5):
+def dukemtmc(input_array, query_camera=5, frame_stride=24):
     """DukeMTMC dataset.
 
     Recorded at 59.940059 fps.
 
     Line format:
     [camera, ID, frame, left, top, width, height, worldX, worldY, feetX, feetyY]
+
+    Rows of other cameras and other frames are masked out of the array
+    before any row is unpacked (see dukemtmc_columns).
     """
-    for line in input_array:
-        camera, person, frame, _, _, _, _, world_x, world_y, _, _ = line
+    yield from dukemtmc_columns(input_array, query_camera, frame_stride).rows()
 
-        camera = int(camera)
-        if camera != query_camera:
-            continue
 
-        frame = int(frame)
-        if frame % 24 != 0:
-            continue
+def dukemtmc_columns(input_array, query_camera=5, frame_stride=24):
+    """Select the rows of one camera and frame stride as compact Tracks."""
+    keep = ((input_array[:, 0].astype(np.int64) == query_camera) &
+            (input_array[:, 2].astype(np.int64) % frame_stride == 0))
+    return Tracks(input_array[keep, 2].astype(np.int64),
+                  input_array[keep, 1].astype(np.int64),
+                  input_array[keep, 7],
+                  input_array[keep, 8])
+
+
+def dukemtmc_hdf5_chunks(input_file, chunk_size, variable='trainData'):
+    """Read a MATLAB v7.3 (HDF5) matrix in chunks of chunk_size rows."""
+    import h5py  # optional, only needed for MATLAB v7.3 files
 
-        yield TrackRow(frame, int(person), world_x, world_y)
+    with h5py.File(input_file, 'r') as f:
+        data = f[variable]  # HDF5 stores the matrix transposed
+        for start in range(0, data.shape[1], chunk_size):
+            yield data[:, start:start + chunk_size].T
+
+
+def dukemtmc_bulk(input_file, query_camera=5, frame_stride=24, chunk_size=1000000):
+    """DukeMTMC bulk reader.
+
+    Only the trainData variable is loaded from the .mat file and rows
+    are selected with a boolean mask over its columns. MATLAB v7.3
+    files are read in chunks, so peak memory is bounded by chunk_size
+    rows instead of the rows of all eight cameras.
+    """
+    with archives.open_binary(input_file) as f:
+        try:
+            chunks = [scipy.io.loadmat(f, variable_names=['trainData'])['trainData']]
+        except NotImplementedError:  # MATLAB v7.3
+            f.seek(0)
+            chunks = dukemtmc_hdf5_chunks(f, chunk_size)
+        return Tracks.concatenate(dukemtmc_columns(chunk, query_camera, frame_stride)
+                                  for chunk in chunks)
 
 
 def wildtrack(filename_content):
@@ -218,7 +490,12 @@ def trajnet_original(line):
                     float(line[2]),
                     float(line[3]))
 
-def cff(line):
+
+def cff(line, location='PIW', frame_stride=4):
+    ## Check Location before tokenizing
+    if ';' + location + ';' not in line:
+        return None
+
     line = [e for e in line.split(';') if e != '']
 
     ## Time Stamp
@@ -233,7 +510,7 @@ def cff(line):
         return None
 
     ## Check Location
-    if line[1] != 'PIW':
+    if line[1] != location:
         return None
 
     ## Check Time Format
@@ -250,7 +527,7 @@ def cff(line):
     ## Extract Frame
     f += int(time[-3])*1000 + int(time[-2])*10 + int(time[-1][0])
 
-    if f % 4 == 0:
+    if f % frame_stride == 0:
         return TrackRow(f,  # shift from 1-index to 0-index
                         ped_id,
                         float(line[2])/1000,
@@ -258,6 +535,78 @@ def cff(line):
     return None
 
 
+def newline_ranges(input_file, n_ranges):
+    """Cut a file into about n_ranges byte ranges that end on a newline."""
+    with open(input_file, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if not size:
+            return []
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            step = max(1, size // max(1, n_ranges))
+            ranges = []
+            start = 0
+            while start < size:
+                end = mm.find(b'\n', min(start + step, size) - 1)
+                end = size if end == -1 else end + 1
+                ranges.append((start, end))
+                start = end
+    return ranges
+
+
+def cff_text(text_location_stride):
+    """Parse the lines of a block of CFF text."""
+    text, location, frame_stride = text_location_stride
+    rows = (cff(line, location, frame_stride) for line in text.splitlines())
+    return Tracks.from_rows(row for row in rows if row is not None)
+
+
+def cff_byte_range(input_file_range):
+    """Parse the lines of one byte range of a CFF file."""
+    input_file, (start, end), location, frame_stride = input_file_range
+    with open(input_file, 'rb') as f, \
+         mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        text = mm[start:end].decode('utf8', 'ignore')
+    return cff_text((text, location, frame_stride))
+
+
+def newline_blocks(text_file, block_size=1 << 26):
+    """Read a text stream in blocks of about block_size that end on a newline."""
+    rest = ''
+    for block in iter(lambda: text_file.read(block_size), ''):
+        block = rest + block
+        end = block.rfind('\n') + 1
+        rest = block[end:]
+        if end:
+            yield block[:end]
+    if rest:
+        yield rest
+
+
+def cff_parallel(input_file, processes=None, location='PIW', frame_stride=4):
+    """Parallel bulk reader for CFF.
+
+    The memory-mapped file is cut into newline-aligned byte ranges
+    that are parsed with cff() in a process pool. The parsed ranges are
+    concatenated in file order and so give the same rows as reading
+    the file line by line.
+
+    Members of an archive cannot be memory-mapped. They are read
+    sequentially in newline-aligned blocks that are parsed in the
+    process pool while the next blocks are read, with at most two
+    blocks per process read ahead.
+    """
+    processes = processes or os.cpu_count() or 1
+    if archives.split(input_file)[0] is not None:
+        with archives.open_text(input_file) as f:
+            blocks = ((block, location, frame_stride) for block in newline_blocks(f))
+            return Tracks.concatenate(parallel_map(cff_text, blocks, processes,
+                                                   max_pending=2 * processes))
+
+    ranges = [(input_file, r, location, frame_stride)
+              for r in newline_ranges(input_file, 4 * processes)]
+    return Tracks.concatenate(parallel_map(cff_byte_range, ranges, processes))
+
+
 def lcas(line):
     line = [e for e in line.split(',') if e != '']
     return TrackRow(int(float(line[0])),
@@ -265,6 +614,9 @@ def lcas(line):
                     float(line[2]),
                     float(line[3]))
 
+def lcas_bulk(input_file):
+    return read_columns(input_file, delimiter=',')
+
 def controlled(line):
     line = [e for e in line.split(', ') if e != '']
     return TrackRow(int(float(line[0])),
@@ -272,6 +624,9 @@ def controlled(line):
                     float(line[2]),
                     float(line[3]))
 
+def controlled_bulk(input_file):
+    return read_columns(input_file, delimiter=',')
+
 def get_trackrows(line):
     line = json.loads(line)
     track = line.get('track')
@@ -280,6 +635,45 @@ def get_trackrows(line):
                         track.get('prediction_number'))
     return None
 
+## track lines as written by trajnetplusplustools.writers
+TRAJNET_TRACK = re.compile(r'\{"track": \{"f": (-?\d+), "p": (-?\d+), "x": ([^,}]+), "y": ([^,}]+)'
+                           r'(?:, "prediction_number": (-?\d+))?')
+TRAJNET_SCENE = re.compile(r'^.*"scene":.*$', re.MULTILINE)
+
+def trajnet_bulk(input_file):
+    """Read a TrajNet++ .ndjson file once as (Tracks, [SceneRow]).
+
+    Track lines in the layout of trajnetplusplustools.writers are parsed
+    with one regular expression over the whole file, straight into
+    columns. Only the few scene lines are decoded with json. Files in
+    another layout fall back to decoding every line.
+    """
+    text = read_text(input_file)
+
+    scenes = []
+    for line in TRAJNET_SCENE.findall(text):
+        scene = json.loads(line)['scene']
+        scenes.append(SceneRow(scene['id'], scene['p'], scene['s'], scene['e'],
+                               scene.get('fps'), scene.get('tag')))
+
+    tracks = TRAJNET_TRACK.findall(text)
+    if len(tracks) != text.count('"track":'):
+        rows = (get_trackrows(line) for line in text.splitlines() if line.strip())
+        return Tracks.from_rows(row for row in rows if row is not None), scenes
+    if not tracks:
+        return Tracks.empty(), scenes
+
+    frame, pedestrian, x, y, prediction_number = zip(*tracks)
+    if any(prediction_number):
+        prediction_number = [int(p) if p else -1 for p in prediction_number]
+    else:
+        prediction_number = None
+    return Tracks(np.array(frame, dtype=np.int64),
+                  np.array(pedestrian, dtype=np.int64),
+                  np.array(x, dtype=np.float64),
+                  np.array(y, dtype=np.float64),
+                  prediction_number), scenes
+
 def standard(line):
     line = [e for e in line.split('\t') if e != '']
     return TrackRow(int(float(line[0])),
@@ -287,8 +681,18 @@ def standard(line):
                     float(line[2]),
                     float(line[3]))
 
-def car_data(filename_content):
-    frame_id = int(filename_content[0].split('.')[0].split('/')[-1])
+def standard_bulk(input_file):
+    return read_columns(input_file)
+
+def car_data_frame(file_name):
+    return int(os.path.basename(file_name).split('.')[0])
+
+def car_data(filename_content, frame_stride=12):
+    frame_id = car_data_frame(filename_content[0])
+    ## Skip the whole file for frames that are not kept
+    if frame_id % frame_stride != 0:
+        return
+
     ratio = 5.0 / 162 ## 162 pix = 5 m
     lines = filename_content[1].split('\n')
     ## First Line: ID, Front1x, Front1y, Front2x, Front2y, Back1x, Back1y, Back2x, Back2y, Type, Occlusion
@@ -302,7 +706,4 @@ def car_data(filename_content):
         if int(type_) != 2:
             continue
 
-        if int(frame_id) % 12 != 0:
-            continue
-
         yield TrackRow(frame_id, int(id_), ratio * float(F1x), ratio * float(F1y))
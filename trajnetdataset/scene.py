@@ -1,10 +1,68 @@
 """ Preparng Scenes for TrajNet """
-import os
-from collections import defaultdict
-
-import trajnetplusplustools
+import numpy as np
 from trajnetplusplustools import SceneRow
 
+from .tracks import as_tracks
+from .writers import write_scenes
+
+
+def close_flags(frame, x, y, cell_size=10, radius=None):
+    """Vectorized computation of spatially close rows.
+
+    A row is close when another row of the same frame occupies the same
+    grid cell of cell_size meters. With a radius, a row is instead close
+    when another row of the same frame is within radius meters. Cells
+    are then radius wide and the neighbouring cells are searched too, so
+    rows just across a cell boundary are found.
+
+    :return: boolean array with one flag per row
+    """
+    if radius is not None:
+        cell_size = radius
+    cell_x = np.floor_divide(x, cell_size).astype(np.int64)
+    cell_y = np.floor_divide(y, cell_size).astype(np.int64)
+    flags = np.zeros(len(frame), dtype=bool)
+    if not len(frame):
+        return flags
+
+    # one sortable integer key per (frame, cell), with room for neighbours
+    cell_x = cell_x - cell_x.min() + 1
+    cell_y = cell_y - cell_y.min() + 1
+    size_x = int(cell_x.max()) + 2
+    size_y = int(cell_y.max()) + 2
+    frame_key = frame - frame.min()
+    if (int(frame_key.max()) + 1) * size_x * size_y >= 2**62:
+        frame_key = np.unique(frame, return_inverse=True)[1].reshape(-1)
+    keys = (frame_key * size_x + cell_x) * size_y + cell_y
+    order = np.argsort(keys)
+    keys = keys[order]
+
+    if radius is None:
+        first = np.flatnonzero(np.diff(keys, prepend=keys[0] - 1))
+        counts = np.diff(np.append(first, len(keys)))
+        flags[order] = np.repeat(counts > 1, counts)
+        return flags
+
+    x_sorted = x[order]
+    y_sorted = y[order]
+    flags_sorted = np.zeros(len(order), dtype=bool)
+    row_index = np.arange(len(order))
+    for dx in (-1, 0, 1):
+        for dy in (-1, 0, 1):
+            neighbour_keys = keys + dx * size_y + dy
+            start = np.searchsorted(keys, neighbour_keys, side='left')
+            n_candidates = np.searchsorted(keys, neighbour_keys, side='right') - start
+            # all (row, candidate) pairs of this neighbour cell
+            i = np.repeat(row_index, n_candidates)
+            first_pair = np.cumsum(n_candidates) - n_candidates
+            j = np.repeat(start - first_pair, n_candidates) + np.arange(len(i))
+            close = ((i != j) &
+                     ((x_sorted[i] - x_sorted[j]) ** 2 + (y_sorted[i] - y_sorted[j]) ** 2
+                      <= radius ** 2))
+            flags_sorted[i[close]] = True
+    flags[order] = flags_sorted
+    return flags
+
 
 class Scenes(object):
     def __init__(self, fps, start_scene_id=0, args=None):
@@ -16,107 +74,155 @@ class Scenes(object):
         self.frames = set()
         self.fps = fps
         self.min_length = args.min_length
+        self.proximity_radius = args.proximity_radius
 
-    @staticmethod
-    def euclidean_distance_2(row1, row2):
-        """Euclidean distance squared between two rows."""
-        return (row1.x - row2.x)**2 + (row1.y - row2.y)**2
+        ## scenes and tracks of the last generated split, for categorization
+        self.scenes = []
+        self.tracks = None
+        self.observed_tracks = None
 
     @staticmethod
-    def close_pedestrians(rows, cell_size=10):
-        """Fast computation of spatially close pedestrians.
+    def continuous_windows(windows, tolerance=1.5):
+        """Whether the frames of every row of a 2D array have no gap.
 
-        By frame, get the list of pedestrian ids that or close to other
-        pedestrians. Approximate with multi-occupancy of discrete grid cells.
+        A row has a gap when an increment of its frames exceeds tolerance
+        times its median increment.
         """
-        sparse_occupancy = defaultdict(list)
-        for row in rows:
-            x = int(row.x // cell_size * cell_size)
-            y = int(row.y // cell_size * cell_size)
-            sparse_occupancy[(x, y)].append(row.pedestrian)
-        return {ped_id
-                for cell in sparse_occupancy.values() if len(cell) > 1
-                for ped_id in cell}
+        increments = np.diff(windows, axis=1)
+        median_index = int(increments.shape[1] / 2)
+        median_increment = np.partition(increments, median_index, axis=1)[:, median_index]
+        return median_increment * tolerance > increments.max(axis=1)
 
-    @staticmethod
-    def continuous_frames(frames, tolerance=1.5):
-        increments = [f2 - f1 for f1, f2 in zip(frames[:-1], frames[1:])]
-        median_increment = sorted(increments)[int(len(increments) / 2)]
-        ok = median_increment * tolerance > max(increments)
+    def from_rows(self, rows):
+        """Scenes of the rows as SceneRows.
 
-        # if not ok:
-        #     print('!!!!!!!!! DETECTED GAP IN FRAMES')
-        #     print(increments)
+        rows are Tracks or, for compatibility, an iterable of TrackRows.
+        """
+        scenes = self.scene_frames(as_tracks(rows))
+        for _, scene_frames in scenes:
+            self.frames |= set(scene_frames
+                               if self.visible_chunk is None
+                               else scene_frames[:self.visible_chunk])
+        return self.scene_rows(scenes)
 
-        return ok
+    def scene_frames(self, rows):
+        """Scenes of the Tracks as (pedestrian of interest, [frames]).
 
-    def from_rows(self, rows):
-        count_by_frame = rows.groupBy(lambda r: r.frame).mapValues(len).collectAsMap()
-        occupancy_by_frame = (rows
-                              .groupBy(lambda r: r.frame)
-                              .mapValues(self.close_pedestrians)
-                              .collectAsMap())
-
-        def to_scene_row(ped_frames):
-            ped_id, scene_frames = ped_frames
-            row = SceneRow(self.scene_id, ped_id, scene_frames[0], scene_frames[-1], self.fps, 0)
-            self.scene_id += 1
-            return row
+        Pedestrians are visited in order of their first row.
+        """
+        frame_index = FrameIndex(rows, radius=self.proximity_radius)
+
+        # pedestrian paths sorted by frame, in order of first appearance
+        order, _, ped_bounds = rows.group_index('pedestrian')
+        paths = [order[start:end] for start, end
+                 in sorted(zip(ped_bounds[:-1], ped_bounds[1:]), key=lambda b: order[b[0]])
+                 if end - start >= self.chunk_size]
 
         # scenes: pedestrian of interest, [frames]
-        scenes = (
-            rows
-            .groupBy(lambda r: r.pedestrian)
-            .filter(lambda p_path: len(p_path[1]) >= self.chunk_size)
-            .mapValues(lambda path: sorted(path, key=lambda p: p.frame))
-            .flatMapValues(lambda path: [
-                [path[ii].frame for ii in range(i, i + self.chunk_size)]
-                for i in range(0, len(path) - self.chunk_size + 1, self.chunk_stride)
-                # filter for pedestrians moving by more than min_length meter
-                if self.euclidean_distance_2(path[i], path[i+self.chunk_size-1]) > self.min_length
-            ])
+        scenes = []
+        for path_index in paths:
+            path_index = path_index[np.argsort(rows.frame[path_index], kind='stable')]
+            frames = rows.frame[path_index]
+            starts = np.arange(0, len(path_index) - self.chunk_size + 1, self.chunk_stride)
+            ends = starts + self.chunk_size
+
+            # filter for pedestrians moving by more than min_length meter
+            x = rows.x[path_index]
+            y = rows.y[path_index]
+            keep = (x[starts] - x[ends - 1])**2 + (y[starts] - y[ends - 1])**2 > self.min_length
 
             # filter out scenes with large gaps in frame numbers
-            .filter(lambda ped_frames: self.continuous_frames(ped_frames[1]))
+            windows = np.lib.stride_tricks.sliding_window_view(frames, self.chunk_size)
+            keep &= self.continuous_windows(windows[starts])
 
             # filter for scenes that have some activity
-            .filter(lambda ped_frames:
-                    sum(count_by_frame[f] for f in ped_frames[1]) >= 2.0 * self.chunk_size)
+            # (prefix sums: constant time per window)
+            activity = np.concatenate(([0], np.cumsum(frame_index.row_counts[path_index])))
+            keep &= activity[ends] - activity[starts] >= 2.0 * self.chunk_size
 
             # require some proximity to other pedestrians
-            .filter(lambda ped_frames:
-                    ped_frames[0] in {p
-                                      for frame in ped_frames[1]
-                                      for p in occupancy_by_frame[frame]})
+            close = np.concatenate(([0], np.cumsum(frame_index.pedestrian_close[path_index])))
+            keep &= close[ends] > close[starts]
 
-            .cache()
-        )
+            ped_id = int(rows.pedestrian[path_index[0]])
+            scenes += [(ped_id, scene_frames) for scene_frames in windows[starts[keep]].tolist()]
 
-        self.frames |= set(scenes
-                           .flatMap(lambda ped_frames:
-                                    ped_frames[1]
-                                    if self.visible_chunk is None
-                                    else ped_frames[1][:self.visible_chunk])
-                           .toLocalIterator())
+        return scenes
 
-        return scenes.map(to_scene_row)
+    def scene_rows(self, scenes):
+        """SceneRows with consecutive scene ids."""
+        scene_rows = []
+        for ped_id, scene_frames in scenes:
+            scene_rows.append(SceneRow(self.scene_id, ped_id, scene_frames[0], scene_frames[-1],
+                                       self.fps, 0))
+            self.scene_id += 1
+        return scene_rows
 
 
-    def rows_to_file(self, rows, output_file):
+    def rows_to_file(self, rows, output_file, write_file=True):
         if '/test/' in output_file:
             print('Output File: ', output_file)
             self.visible_chunk = self.obs_len
         else:
             self.visible_chunk = None
-        scenes = self.from_rows(rows)
-        tracks = rows.filter(lambda r: r.frame in self.frames)
-        all_data = rows.context.union((scenes, tracks))
+        rows = as_tracks(rows)
+        self.scenes = self.from_rows(rows)
+        self.tracks = rows.in_frames(self.frames)
+
+        ## write scenes and tracks, replaces a previously generated file
+        if write_file:
+            write_scenes(output_file, self.scenes, self.tracks)
 
-        ## removes the file, if previously generated
-        if os.path.isfile(output_file):
-            os.remove(output_file)
+        return self
 
-        ## write scenes and tracks
-        all_data.map(trajnetplusplustools.writers.trajnet).saveAsTextFile(output_file)
+    def rows_to_test_files(self, rows, test_output_file, private_output_file, write_files=True):
+        """Write the public and the private test file from one set of scenes.
+
+        The same as rows_to_file() for both files, but the scenes are only
+        generated once. The public file only gets the tracks of the first
+        obs_len frames of every scene.
+        """
+        print('Output File: ', test_output_file)
+        rows = as_tracks(rows)
+        scenes = self.scene_frames(rows)
+        self.scenes = self.scene_rows(scenes)
+
+        self.frames = {f for _, scene_frames in scenes for f in scene_frames}
+        self.tracks = rows.in_frames(self.frames)
+        observed_frames = [f for _, scene_frames in scenes for f in scene_frames[:self.obs_len]]
+        self.observed_tracks = self.tracks.in_frames(observed_frames)
+
+        if write_files:
+            write_scenes(test_output_file, self.scenes, self.observed_tracks)
+            write_scenes(private_output_file, self.scenes, self.tracks)
 
         return self
+
+
+class FrameIndex(object):
+    """Per-row statistics of the frames of one split, built in a single pass.
+
+    Per row, row_counts is the number of rows in its frame and
+    pedestrian_close whether its pedestrian is close to others in its
+    frame (see close_flags).
+    """
+    def __init__(self, rows, cell_size=10, radius=None):
+        order, _, bounds = rows.group_index('frame')
+        counts = np.diff(bounds)
+        self.row_counts = np.empty(len(rows), dtype=np.int64)
+        self.row_counts[order] = np.repeat(counts, counts)
+
+        is_close = close_flags(rows.frame, rows.x, rows.y, cell_size, radius)
+
+        # a pedestrian with several rows in a frame is close if any of them is
+        ped_frame_order = np.lexsort((rows.frame, rows.pedestrian))
+        pedestrian = rows.pedestrian[ped_frame_order]
+        frame = rows.frame[ped_frame_order]
+        new_group = np.ones(len(rows), dtype=bool)
+        new_group[1:] = (pedestrian[1:] != pedestrian[:-1]) | (frame[1:] != frame[:-1])
+        ped_frame_starts = np.flatnonzero(new_group)
+        self.pedestrian_close = np.zeros(len(rows), dtype=bool)
+        if len(rows):
+            self.pedestrian_close[ped_frame_order] = np.repeat(
+                np.logical_or.reduceat(is_close[ped_frame_order], ped_frame_starts),
+                np.diff(np.append(ped_frame_starts, len(rows))))
@@ -0,0 +1,290 @@
+""" Categorization sweeps over stored per-scene metrics
+
+With --metrics, convert saves next to every categorized split the raw
+per-scene quantities behind the categorization thresholds and the
+acceptance ratios (see scene_metrics()). A sweep re-applies many
+threshold and acceptance configurations to those metrics, without
+building the scenes again:
+
+    python -m trajnetdataset.sweep sweep.json output/{split}/biwi_hotel.ndjson
+
+sweep.json is a list of configurations, each a dict of categorizer
+arguments of convert (static_threshold, linear_threshold,
+inter_dist_thresh, inter_pos_range, grp_dist_thresh, grp_std_thresh,
+acceptance, all_present) and an optional name. Arguments not given keep
+the values of the categorization that saved the metrics. inter_pos_range
+has to be one of the angle ranges of the metrics (--metric_pos_ranges).
+The tag counts of every configuration are printed and, with --output_dir,
+the categorized files and the tag counts are written.
+"""
+
+import argparse
+import hashlib
+import json
+import os
+
+import numpy as np
+from trajnetplusplustools import SceneRow
+
+from . import kalman
+from .interactions import interaction_metrics, GROUP, OTHERS
+from .tracks import Tracks
+from .writers import write_scenes
+
+SWEEP_ARGUMENTS = ('static_threshold', 'linear_threshold', 'inter_dist_thresh', 'inter_pos_range',
+                   'grp_dist_thresh', 'grp_std_thresh', 'acceptance', 'all_present')
+SPLITS = ('train', 'val', 'test_private')
+
+
+def metrics_path(path):
+    """Metrics file of the categorized split written to path."""
+    return path.replace('output_pre', 'output').split('.ndjson')[0] + '.metrics.npz'
+
+
+def content_hash(metrics, tracks):
+    """sha1 of the scenes of metrics and of the track records."""
+    content = hashlib.sha1()
+    for array in (metrics['scene'], metrics['pedestrian'], metrics['frames'],
+                  metrics['frame_offsets'], tracks):
+        content.update(np.ascontiguousarray(array).tobytes())
+    return content.hexdigest()
+
+
+def load_metrics(path):
+    """Metrics saved for the categorized split written to path, without the tracks."""
+    with np.load(metrics_path(path)) as metrics:
+        return {key: metrics[key] for key in metrics.files if key != 'tracks'}
+
+
+def load_tracks(path):
+    """Track records saved with the metrics of path."""
+    with np.load(metrics_path(path)) as metrics:
+        return metrics['tracks']
+
+
+def acceptance_draws(scene_id, args):
+    """The uniform draw of the acceptance of a scene in get_type.categorize_scene().
+
+    The first is drawn for static scenes, the second for all others,
+    after the draws of the Kalman samples.
+    """
+    static_draw = np.random.RandomState([args.seed, scene_id]).uniform()
+    random_state = np.random.RandomState([args.seed, scene_id])
+    random_state.standard_normal(kalman.n_draws(args.pred_len))
+    return static_draw, random_state.uniform()
+
+
+def scene_metrics(rows, scene_rows, scenes, scenes_xy, fde, fps, args):
+    """Per-scene metrics of categorization, as a dict of arrays.
+
+    scenes are the paths of TrackRows of scene_rows, scenes_xy their
+    xy-coordinates, fde the Kalman final displacements and rows the
+    Tracks of the split.
+
+    Per scene: the displacement of the primary pedestrian (Type I), the
+    Kalman final displacement (Type II), the distances of the cone tests
+    for every angle range of args.metric_pos_ranges and the mean and std
+    distance of the neighbours on the side (Type III and interaction
+    types, see interactions.interaction_metrics()), the acceptance draws
+    and whether all pedestrians are present. The frames of the primary
+    pedestrian and the tracks of the split are kept to write outputs.
+    """
+    pos_ranges = sorted(set([args.inter_pos_range] + list(args.metric_pos_ranges or [])))
+    front, leader_follower, collision_avoidance, group_mean, group_std, group_offsets = \
+        interaction_metrics(scenes_xy, args, pos_ranges)
+    primary_frames = [[row.frame for row in scene[0]] for scene in scenes]
+
+    metrics = dict(
+        scene=np.array([scene_row.scene for scene_row in scene_rows], dtype=np.int64),
+        pedestrian=np.array([scene[0][0].pedestrian for scene in scenes], dtype=np.int64),
+        frames=np.array([f for frames in primary_frames for f in frames], dtype=np.int64),
+        frame_offsets=np.cumsum([0] + [len(frames) for frames in primary_frames]),
+        tracks=rows.to_records(),
+        displacement=np.array([np.sqrt((scene[0][0].x - scene[0][-1].x) ** 2 +
+                                       (scene[0][0].y - scene[0][-1].y) ** 2)
+                               for scene in scenes]),
+        kalman_fde=np.array([np.nan if value is None else value for value in fde]),
+        acceptance_draws=np.array([acceptance_draws(scene_row.scene, args)
+                                   for scene_row in scene_rows]).reshape(-1, 2),
+        all_present=np.array([not np.isnan(xy).any() for xy in scenes_xy], dtype=bool),
+        pos_ranges=np.array(pos_ranges),
+        front_dist=front,
+        leader_follower_dist=leader_follower,
+        collision_avoidance_dist=collision_avoidance,
+        group_mean=group_mean,
+        group_std=group_std,
+        group_offsets=group_offsets,
+    )
+    metrics['content_hash'] = np.array(content_hash(metrics, metrics['tracks']))
+    metrics['config'] = np.array(json.dumps(dict(
+        {key: getattr(args, key) for key in SWEEP_ARGUMENTS},
+        obs_len=args.obs_len, fps=fps)))
+    return metrics
+
+
+def write_metrics(path, metrics):
+    """Write metrics to the metrics file of path."""
+    output_path = metrics_path(path)
+    output_dir = os.path.dirname(output_path)
+    if output_dir:
+        os.makedirs(output_dir, exist_ok=True)
+    np.savez(output_path, **metrics)
+
+
+def sweep_config(metrics, config):
+    """Categorization arguments of metrics, updated with the dict config."""
+    unknown = set(config) - set(SWEEP_ARGUMENTS) - {'name'}
+    if unknown:
+        raise ValueError('unknown sweep arguments: {}'.format(sorted(unknown)))
+    args = json.loads(str(metrics['config']))
+    args.update((key, value) for key, value in config.items() if key != 'name')
+    args = argparse.Namespace(**args)
+    if len(args.acceptance) != 4:
+        raise ValueError('acceptance needs a ratio for each of the 4 types')
+    return args
+
+
+def categorize(metrics, args):
+    """Categorization of all scenes of metrics with the arguments args.
+
+    The same as get_type.categorize_scene() without ORCA validity.
+
+    :return: (tags, types, accepted) with tags the Type (1 to 4) of
+             every scene, types a boolean (scenes, 4) array of the
+             interaction types of Type III scenes and accepted whether a
+             scene is kept
+    """
+    pos_ranges = metrics['pos_ranges'].tolist()
+    if args.inter_pos_range not in pos_ranges:
+        raise ValueError('inter_pos_range {} is not one of the angle ranges {} of the metrics'
+                         .format(args.inter_pos_range, pos_ranges))
+    r = pos_ranges.index(args.inter_pos_range)
+    n_scenes = len(metrics['scene'])
+    group_scene = np.repeat(np.arange(n_scenes), np.diff(metrics['group_offsets']))
+
+    def group(dist_thresh, std_thresh):
+        close = (metrics['group_mean'] < dist_thresh) & (metrics['group_std'] < std_thresh)
+        return np.bincount(group_scene[close], minlength=n_scenes) > 0
+
+    static = metrics['displacement'] < args.static_threshold
+    linear = ~static & (metrics['kalman_fde'] < args.linear_threshold)
+    interaction = ~static & ~linear & (
+        (metrics['front_dist'][:, r] < args.inter_dist_thresh) |
+        group(args.grp_dist_thresh, args.grp_std_thresh))
+    tags = np.select([static, linear, interaction], [1, 2, 3], 4)
+
+    types = np.zeros((n_scenes, 4), dtype=bool)
+    types[:, 0] = metrics['leader_follower_dist'][:, r] < args.inter_dist_thresh
+    types[:, 1] = metrics['collision_avoidance_dist'][:, r] < args.inter_dist_thresh
+    types[:, GROUP - 1] = group(0.8, 0.2)
+    types[:, OTHERS - 1] = ~np.any(types[:, :3], axis=1)
+    types[tags != 3] = False
+
+    draws = np.where(static, metrics['acceptance_draws'][:, 0], metrics['acceptance_draws'][:, 1])
+    accepted = draws < np.asarray(args.acceptance)[tags - 1]
+    if args.all_present:
+        accepted &= metrics['all_present']
+    return tags, types, accepted
+
+
+def write(metrics, records, path, test_path, tags, types, accepted, track_id, args):
+    """Write the accepted scenes of a split like get_type.trajectory_type().
+
+    records are the track records of the split.
+
+    :return: the next track_id
+    """
+    if content_hash(metrics, records) != str(metrics['content_hash']):
+        raise ValueError('scenes and tracks do not match the content hash of the metrics')
+    tracks = Tracks.from_records(records)
+    fps = args.fps
+    frames = metrics['frames']
+    frame_offsets = metrics['frame_offsets']
+
+    new_scenes, new_scenes_test = [], []
+    new_frames, new_frames_test = [], []
+    for i in np.flatnonzero(accepted).tolist():
+        scene_frames = frames[frame_offsets[i]:frame_offsets[i + 1]]
+        scene_tag = [int(tags[i]), (np.flatnonzero(types[i]) + 1).tolist()]
+        start, end = int(scene_frames[0]), int(scene_frames[-1])
+        pedestrian = int(metrics['pedestrian'][i])
+        new_scenes.append(SceneRow(track_id, pedestrian, start, end, fps, scene_tag))
+        new_frames.append(scene_frames)
+        if test_path is not None:
+            new_scenes_test.append(SceneRow(track_id, pedestrian, start, end, fps, 0))
+            new_frames_test.append(scene_frames[:args.obs_len])
+        track_id += 1
+
+    tracks = tracks.in_frames(np.concatenate([np.zeros(0, dtype=np.int64)] + new_frames))
+    write_scenes(path, new_scenes, tracks)
+    if test_path is not None:
+        write_scenes(test_path, new_scenes_test, tracks.in_frames(
+            np.concatenate([np.zeros(0, dtype=np.int64)] + new_frames_test)))
+    return track_id
+
+
+def sweep(configs, paths, output_dir=None):
+    """Categorize the splits of paths with every configuration.
+
+    paths are the categorized files with a {split} placeholder. With
+    output_dir, the files of every configuration are written to
+    output_dir/<name>/<split>/.
+
+    :return: the tag counts by configuration name, path and split
+    """
+    counts = {}
+    for n, config in enumerate(configs):
+        name = str(config.get('name', 'config_{}'.format(n)))
+        counts[name] = {}
+        for path in paths:
+            counts[name][path] = {}
+            track_id = 0
+            for split in SPLITS:
+                split_path = path.format(split=split)
+                if not os.path.exists(metrics_path(split_path)):
+                    continue
+                metrics = load_metrics(split_path)
+                args = sweep_config(metrics, config)
+                tags, types, accepted = categorize(metrics, args)
+
+                counts[name][path][split] = {
+                    'scenes': int(np.sum(accepted)),
+                    'tags': np.bincount(tags[accepted], minlength=5)[1:].tolist(),
+                    'sub_tags': np.sum(types[accepted], axis=0).tolist(),
+                    'content_hash': str(metrics['content_hash']),
+                }
+                print(name, split_path, 'Tags', counts[name][path][split]['tags'],
+                      'Sub Tags', counts[name][path][split]['sub_tags'])
+
+                if output_dir is not None:
+                    output_path = os.path.join(output_dir, name, split, os.path.basename(split_path))
+                    test_path = None
+                    if split == 'test_private':
+                        test_path = os.path.join(output_dir, name, 'test',
+                                                 os.path.basename(split_path))
+                    track_id = write(metrics, load_tracks(split_path), output_path, test_path,
+                                     tags, types, accepted, track_id, args)
+    return counts
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('configs',
+                        help='json file with the list of categorization configurations')
+    parser.add_argument('paths', nargs='+',
+                        help='categorized files with metrics, with a {split} placeholder')
+    parser.add_argument('--output_dir', default=None,
+                        help='write the categorized files and tag counts of every configuration')
+    args = parser.parse_args()
+
+    with open(args.configs) as f:
+        configs = json.load(f)
+    counts = sweep(configs, args.paths, args.output_dir)
+    if args.output_dir is not None:
+        os.makedirs(args.output_dir, exist_ok=True)
+        with open(os.path.join(args.output_dir, 'counts.json'), 'w') as f:
+            json.dump(counts, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
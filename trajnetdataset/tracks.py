@@ -0,0 +1,156 @@
+""" Columnar storage of TrackRows """
+
+import numpy as np
+
+from trajnetplusplustools import TrackRow
+
+
+class Tracks(object):
+    """Track rows stored as typed columns.
+
+    frame and pedestrian are int64 arrays, x and y are float64 arrays.
+    prediction_number is an optional int64 array where -1 stands for
+    rows without a prediction number.
+    TrackRows are only created on demand through :meth:`rows`.
+
+    Indexes by frame and by pedestrian are built on first use and
+    reused afterwards (see :meth:`group_index`).
+    """
+    DTYPE = np.dtype([('frame', '<i8'), ('pedestrian', '<i8'), ('x', '<f8'), ('y', '<f8')])
+
+    def __init__(self, frame, pedestrian, x, y, prediction_number=None):
+        self.frame = np.asarray(frame, dtype=np.int64)
+        self.pedestrian = np.asarray(pedestrian, dtype=np.int64)
+        self.x = np.asarray(x, dtype=np.float64)
+        self.y = np.asarray(y, dtype=np.float64)
+        self.prediction_number = None
+        if prediction_number is not None:
+            self.prediction_number = np.asarray(prediction_number, dtype=np.int64)
+        self._indexes = {}
+
+    def __len__(self):
+        return len(self.frame)
+
+    @classmethod
+    def empty(cls):
+        return cls(np.zeros(0), np.zeros(0), np.zeros(0), np.zeros(0))
+
+    @classmethod
+    def from_rows(cls, rows):
+        """Collect an iterable of TrackRows into columns."""
+        rows = list(rows)
+        if not rows:
+            return cls.empty()
+        prediction_number = None
+        if any(r.prediction_number is not None for r in rows):
+            prediction_number = [-1 if r.prediction_number is None else r.prediction_number
+                                 for r in rows]
+        return cls([r.frame for r in rows],
+                   [r.pedestrian for r in rows],
+                   [r.x for r in rows],
+                   [r.y for r in rows],
+                   prediction_number)
+
+    @classmethod
+    def from_records(cls, records):
+        """Columns from a structured array of DTYPE, without copying."""
+        return cls(records['frame'], records['pedestrian'], records['x'], records['y'])
+
+    def to_records(self):
+        """Structured array of DTYPE."""
+        records = np.empty(len(self), dtype=self.DTYPE)
+        records['frame'] = self.frame
+        records['pedestrian'] = self.pedestrian
+        records['x'] = self.x
+        records['y'] = self.y
+        return records
+
+    @classmethod
+    def concatenate(cls, tracks):
+        tracks = list(tracks)
+        if not tracks:
+            return cls.empty()
+        prediction_number = None
+        if any(t.prediction_number is not None for t in tracks):
+            prediction_number = np.concatenate([
+                t.prediction_number if t.prediction_number is not None
+                else np.full(len(t), -1, dtype=np.int64)
+                for t in tracks
+            ])
+        return cls(np.concatenate([t.frame for t in tracks]),
+                   np.concatenate([t.pedestrian for t in tracks]),
+                   np.concatenate([t.x for t in tracks]),
+                   np.concatenate([t.y for t in tracks]),
+                   prediction_number)
+
+    def filter(self, mask):
+        """Select rows with a boolean mask or an index array."""
+        prediction_number = None
+        if self.prediction_number is not None:
+            prediction_number = self.prediction_number[mask]
+        return Tracks(self.frame[mask], self.pedestrian[mask], self.x[mask], self.y[mask],
+                      prediction_number)
+
+    def in_frames(self, frames):
+        """Select the rows of the given frames, keeping their order.
+
+        frames is an iterable or an array of frames, repeated frames are
+        fine. The rows are taken as slices of the frame index (see
+        group_index), so once it is built the cost is proportional to the
+        selected rows.
+        """
+        if isinstance(frames, np.ndarray):
+            frames = frames.astype(np.int64, copy=False).reshape(-1)
+        else:
+            frames = np.fromiter(frames, dtype=np.int64)
+        order, keys, bounds = self.group_index('frame')
+        frames = np.unique(frames)
+        if not len(keys):
+            return self.filter(order)
+        position = np.minimum(np.searchsorted(keys, frames), len(keys) - 1)
+        position = position[keys[position] == frames]
+        starts = bounds[position]
+        counts = bounds[position + 1] - starts
+        first = np.cumsum(counts) - counts
+        index = np.repeat(starts - first, counts) + np.arange(int(counts.sum()))
+        return self.filter(np.sort(order[index]))
+
+    def rounded(self, ndigits=2):
+        """Tracks with x and y rounded as in the written trajnet files."""
+        return Tracks(self.frame, self.pedestrian,
+                      [round(v, ndigits) for v in self.x.tolist()],
+                      [round(v, ndigits) for v in self.y.tolist()],
+                      self.prediction_number)
+
+    def group_index(self, column):
+        """Index of the rows by the values of a column.
+
+        Returns (order, keys, bounds): order is a stable argsort of the
+        column, keys are its sorted unique values and the rows of keys[i]
+        are order[bounds[i]:bounds[i + 1]] in their original order.
+        """
+        if column not in self._indexes:
+            values = getattr(self, column)
+            order = np.argsort(values, kind='stable')
+            keys, starts = np.unique(values[order], return_index=True)
+            bounds = np.append(starts, len(values))
+            self._indexes[column] = (order, keys, bounds)
+        return self._indexes[column]
+
+    def rows(self):
+        """Iterate over the columns as TrackRows with plain Python numbers."""
+        if self.prediction_number is None:
+            return map(TrackRow, self.frame.tolist(), self.pedestrian.tolist(),
+                       self.x.tolist(), self.y.tolist())
+        prediction_number = [None if p == -1 else p for p in self.prediction_number.tolist()]
+        return map(TrackRow, self.frame.tolist(), self.pedestrian.tolist(),
+                   self.x.tolist(), self.y.tolist(), prediction_number)
+
+
+def as_tracks(rows):
+    """Tracks from Tracks, an RDD or any other iterable of TrackRows."""
+    if isinstance(rows, Tracks):
+        return rows
+    if hasattr(rows, 'toLocalIterator'):
+        rows = rows.toLocalIterator()
+    return Tracks.from_rows(rows)
@@ -0,0 +1,97 @@
+""" Write rows in trajnet .ndjson format """
+
+import io
+import itertools
+import os
+
+import numpy as np
+import trajnetplusplustools
+
+from .archives import COMPRESSED_OPENERS
+
+BUFFER_SIZE = 1 << 22
+CHUNK_SIZE = 1 << 16
+TRACK_LINE = '{"track": {"f": %d, "p": %d, "x": %r, "y": %r}}\n'
+
+
+def open_output(output_file):
+    """Open output_file for writing text through a large buffer.
+
+    Files ending in .gz, .bz2 or .xz are compressed.
+    """
+    output_dir = os.path.dirname(output_file)
+    if output_dir:
+        os.makedirs(output_dir, exist_ok=True)
+    opener = COMPRESSED_OPENERS.get(os.path.splitext(output_file)[1])
+    if opener is None:
+        return open(output_file, 'w', buffering=BUFFER_SIZE)
+    return io.TextIOWrapper(io.BufferedWriter(opener(output_file, 'wb'), BUFFER_SIZE))
+
+
+def format_tracks(tracks):
+    """Lines of Tracks in chunks, the same as trajnetplusplustools.writers.trajnet.
+
+    Positions are rounded with round(v, 2) like the trajnet writer. Rows
+    with a prediction number or a non-finite position go through the
+    trajnet writer itself.
+    """
+    for start in range(0, len(tracks), CHUNK_SIZE):
+        chunk = tracks.filter(slice(start, start + CHUNK_SIZE))
+        if chunk.prediction_number is not None or \
+           not (np.isfinite(chunk.x).all() and np.isfinite(chunk.y).all()):
+            yield ''.join(trajnetplusplustools.writers.trajnet(row) + '\n' for row in chunk.rows())
+            continue
+        yield ''.join(map(TRACK_LINE.__mod__, zip(
+            chunk.frame.tolist(), chunk.pedestrian.tolist(),
+            [round(v, 2) for v in chunk.x.tolist()],
+            [round(v, 2) for v in chunk.y.tolist()])))
+
+
+def write_scenes(output_file, scenes, tracks):
+    """Write SceneRows followed by the rows of Tracks to output_file."""
+    with open_output(output_file) as f:
+        f.writelines(itertools.chain(
+            (trajnetplusplustools.writers.trajnet(scene) + '\n' for scene in scenes),
+            format_tracks(tracks)))
+
+
+def scene_tensor_dtype(n_frames, max_peds):
+    """Record of one scene in the scene tensor file."""
+    return np.dtype([('scene', '<i8'), ('pedestrian', '<i8'), ('start', '<i8'),
+                     ('tag', '<i8'), ('sub_tags', '?', (4,)), ('num_peds', '<i8'),
+                     ('xy', '<f4', (n_frames, max_peds, 2))])
+
+
+def write_scene_tensors(output_file, scenes, scenes_xy):
+    """Write categorized scenes as one memory-mappable .npy array.
+
+    There is one record per scene with its id, primary pedestrian, start
+    frame, tag, sub-tags as a mask of the four interaction types, number
+    of pedestrians and the positions of all pedestrians in its frames,
+    padded with NaN. scenes are SceneRows with the tag [tag, sub_tags]
+    and scenes_xy their arrays of shape (frames, pedestrians, 2).
+    Scenes with the tag 0 of the public test set get tag 0 and no
+    sub-tags. Read with np.load(output_file, mmap_mode='r').
+    """
+    output_dir = os.path.dirname(output_file)
+    if output_dir:
+        os.makedirs(output_dir, exist_ok=True)
+    n_frames = max((len(xy) for xy in scenes_xy), default=0)
+    max_peds = max((xy.shape[1] for xy in scenes_xy), default=0)
+    dtype = scene_tensor_dtype(n_frames, max_peds)
+    if not scenes:
+        np.save(output_file, np.zeros(0, dtype=dtype))
+        return
+    records = np.lib.format.open_memmap(output_file, mode='w+', dtype=dtype, shape=(len(scenes),))
+    for i, (scene, xy) in enumerate(zip(scenes, scenes_xy)):
+        tag, sub_tags = (scene.tag, []) if scene.tag == 0 else scene.tag
+        record = records[i]
+        record['scene'] = scene.scene
+        record['pedestrian'] = scene.pedestrian
+        record['start'] = scene.start
+        record['tag'] = tag
+        record['sub_tags'] = [t in sub_tags for t in (1, 2, 3, 4)]
+        record['num_peds'] = xy.shape[1]
+        record['xy'] = np.nan
+        record['xy'][:len(xy), :xy.shape[1]] = xy
+    records.flush()